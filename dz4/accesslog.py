@@ -0,0 +1,102 @@
+import json
+import time
+import logging
+import threading
+import collections
+
+FLUSH_INTERVAL = 0.5
+BUFFER_SIZE = 64 * 1024
+FORMATS = ('combined', 'json')
+
+Record = collections.namedtuple('Record', [
+    'time', 'remote', 'request_line', 'status', 'size', 'referer', 'user_agent', 'duration'
+])
+
+
+class AccessLog:
+    """Per-worker access log. The event loop only appends records to a bounded
+    deque (append/popleft are atomic, no lock is taken), a flusher thread
+    formats them and writes one batch per interval. When the disk can not keep
+    up the buffer fills and new records are counted as dropped instead of
+    blocking the loop."""
+
+    def __init__(self, path, log_format='combined', capacity=BUFFER_SIZE, interval=FLUSH_INTERVAL):
+        if log_format not in FORMATS:
+            raise ValueError('Unknown access log format: %s' % log_format)
+        self.capacity = capacity
+        self.interval = interval
+        self.records = collections.deque()
+        self.dropped = 0
+        self.failed = 0
+        self.written = 0
+        self._reported_dropped = 0
+        self._format = self._format_json if log_format == 'json' else self._format_combined
+        self._time_cache = (None, '')
+        self._fd = open(path, 'a')
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='access-log', daemon=True)
+        self._thread.start()
+
+    def log(self, record):
+        if len(self.records) >= self.capacity:
+            self.dropped += 1
+            return
+        self.records.append(record)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._fd.close()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._flush()
+        self._flush()
+
+    def _flush(self):
+        lines = list()
+        records = self.records
+        while records:
+            lines.append(self._format(records.popleft()))
+        if lines:
+            try:
+                self._fd.write(''.join(lines))
+                self._fd.flush()
+                self.written += len(lines)
+            except OSError as e:
+                self.failed += len(lines)
+                logging.error('Cannot write access log: %s', e)
+        # only the event loop thread updates dropped, failed is ours
+        dropped = self.dropped + self.failed
+        if dropped != self._reported_dropped:
+            logging.warning('Access log lost %s records so far (full buffer or write errors).', dropped)
+            self._reported_dropped = dropped
+
+    def _format_time(self, timestamp):
+        second = int(timestamp)
+        if self._time_cache[0] != second:
+            self._time_cache = (second, time.strftime('%d/%b/%Y:%H:%M:%S %z', time.localtime(second)))
+        return self._time_cache[1]
+
+    def _format_combined(self, record):
+        return '{} - - [{}] "{}" {} {} "{}" "{}"\n'.format(
+            record.remote,
+            self._format_time(record.time),
+            record.request_line.decode('utf-8', 'replace'),
+            record.status,
+            record.size or '-',
+            record.referer or '-',
+            record.user_agent or '-',
+        )
+
+    def _format_json(self, record):
+        return json.dumps({
+            'time': record.time,
+            'remote': record.remote,
+            'request': record.request_line.decode('utf-8', 'replace'),
+            'status': record.status,
+            'size': record.size,
+            'referer': record.referer,
+            'user_agent': record.user_agent,
+            'duration_ms': round(record.duration * 1000, 3),
+        }) + '\n'
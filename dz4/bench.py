@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import tempfile
+import platform
+import subprocess
+
+from optparse import OptionParser
+
+HEADER_END = b'\r\n\r\n'
+HTTPD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'httpd.py')
+START_TIMEOUT = 10
+WARMUP_REQUESTS = 200
+
+# (files count, size in bytes) of the synthetic document root
+DOCROOT_LAYOUT = (
+    (60, 1024),
+    (25, 16 * 1024),
+    (10, 128 * 1024),
+    (5, 1024 * 1024),
+)
+
+
+def generate_docroot(root, seed):
+    """Creates the same mix of html and binary files for the same seed, so
+    runs against different commits serve identical content."""
+    rnd = random.Random(seed)
+    paths = list()
+    for count, size in DOCROOT_LAYOUT:
+        for index in range(count):
+            if index % 2:
+                name = 'bin/{}_{}.bin'.format(size, index)
+                data = rnd.getrandbits(size * 8).to_bytes(size, 'little')
+            else:
+                name = 'html/{}_{}.html'.format(size, index)
+                words = ' '.join('w{}'.format(rnd.randrange(1000)) for _ in range(size // 5))
+                data = '<html><body>{}</body></html>'.format(words).encode()[:size]
+            full_path = os.path.join(root, name)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, 'wb') as fd:
+                fd.write(data)
+            paths.append('/' + name)
+    return paths
+
+
+def request_plan(paths, count, seed):
+    rnd = random.Random(seed)
+    return [rnd.choice(paths) for _ in range(count)]
+
+
+def start_server(root, port, workers, loop, logfile):
+    process = subprocess.Popen([
+        sys.executable, HTTPD,
+        '-p', str(port), '-w', str(workers), '-r', root, '-l', logfile, '--loop', loop,
+    ])
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    else:
+        process.kill()
+        raise RuntimeError('Server did not start on port {}'.format(port))
+    # the master spawns workers one by one, give all of them time to listen
+    time.sleep(0.5)
+    return process
+
+
+def worker_pids(master_pid):
+    pids = list()
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as fd:
+                fields = fd.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == master_pid:
+            pids.append(int(name))
+    return sorted(pids)
+
+
+def cpu_seconds(pid):
+    """utime + stime of a process from /proc/<pid>/stat."""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as fd:
+            fields = fd.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return 0.0
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+async def _read_response(reader):
+    raw_headers = await reader.readuntil(HEADER_END)
+    status_line, *header_lines = raw_headers.decode().split('\r\n')
+    length = 0
+    close = False
+    for line in header_lines:
+        name, _, value = line.partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection':
+            close = value.strip().lower() == 'close'
+    await reader.readexactly(length)
+    return int(status_line.split()[1]), len(raw_headers) + length, close
+
+
+async def _client(port, plan, keepalive, stats):
+    connection = 'keep-alive' if keepalive else 'close'
+    reader = writer = None
+    while plan:
+        path = plan.pop()
+        request = 'GET {} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: {}\r\n\r\n'.format(path, connection)
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(request.encode())
+            status, size, close = await _read_response(reader)
+        except (OSError, asyncio.IncompleteReadError):
+            stats['errors'] += 1
+            writer = None
+            continue
+        stats['latencies'].append(time.perf_counter() - started)
+        stats['bytes'] += size
+        if status != 200:
+            stats['errors'] += 1
+        if close or not keepalive:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def drive(port, plan, concurrency, keepalive):
+    stats = dict(latencies=list(), bytes=0, errors=0)
+    plan = list(reversed(plan))
+    started = time.perf_counter()
+    await asyncio.gather(*(_client(port, plan, keepalive, stats) for _ in range(concurrency)))
+    stats['duration'] = time.perf_counter() - started
+    return stats
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_case(opts, root, paths, loop, keepalive):
+    logfile = os.path.join(root, '..', 'httpd-{}.log'.format(loop))
+    server = start_server(root, opts.port, opts.workers, loop, logfile)
+    try:
+        pids = worker_pids(server.pid)
+        asyncio.run(drive(opts.port, request_plan(paths, WARMUP_REQUESTS, opts.seed), opts.concurrency, keepalive))
+        cpu_before = {pid: cpu_seconds(pid) for pid in pids}
+        stats = asyncio.run(drive(opts.port, request_plan(paths, opts.requests, opts.seed),
+                                  opts.concurrency, keepalive))
+        cpu = {str(pid): round(cpu_seconds(pid) - cpu_before[pid], 3) for pid in pids}
+    finally:
+        server.terminate()
+        server.wait()
+    latencies = sorted(stats['latencies'])
+    return {
+        'loop': loop,
+        'keepalive': keepalive,
+        'requests': len(latencies) + stats['errors'],
+        'errors': stats['errors'],
+        'duration': round(stats['duration'], 3),
+        'rps': round(len(latencies) / stats['duration'], 1),
+        'bytes': stats['bytes'],
+        'latency_ms': {
+            'mean': round(1000 * sum(latencies) / max(len(latencies), 1), 3),
+            'p50': round(1000 * percentile(latencies, 0.5), 3),
+            'p90': round(1000 * percentile(latencies, 0.9), 3),
+            'p99': round(1000 * percentile(latencies, 0.99), 3),
+            'max': round(1000 * percentile(latencies, 1.0), 3),
+        },
+        'worker_cpu_seconds': cpu,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(HTTPD), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def default_loops():
+    try:
+        import uvloop  # noqa: F401
+        return 'asyncio,uvloop'
+    except ImportError:
+        return 'asyncio'
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-p", "--port", action="store", type=int, default=8089)
+    parser.add_option("-w", "--workers", action="store", type=int, default=os.cpu_count())
+    parser.add_option("-c", "--concurrency", action="store", type=int, default=100)
+    parser.add_option("-n", "--requests", action="store", type=int, default=20000)
+    parser.add_option("--loops", action="store", type=str, default=default_loops())
+    parser.add_option("--keepalive", action="store", type=str, default='on,off')
+    parser.add_option("--seed", action="store", type=int, default=42)
+    parser.add_option("-o", "--output", action="store", type=str, default=None)
+
+    opts, args = parser.parse_args()
+    keepalive_modes = [mode.strip() == 'on' for mode in opts.keepalive.split(',') if mode.strip()]
+    loops = [loop.strip() for loop in opts.loops.split(',') if loop.strip()]
+
+    with tempfile.TemporaryDirectory(prefix='httpd-bench-') as tmp:
+        root = os.path.join(tmp, 'www')
+        paths = generate_docroot(root, opts.seed)
+        results = [
+            run_case(opts, root, paths, loop, keepalive)
+            for loop in loops
+            for keepalive in keepalive_modes
+        ]
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'config': {
+            'workers': opts.workers,
+            'concurrency': opts.concurrency,
+            'requests': opts.requests,
+            'seed': opts.seed,
+            'docroot': [list(item) for item in DOCROOT_LAYOUT],
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if opts.output:
+        with open(opts.output, 'w') as fd:
+            fd.write(output + '\n')
+    print(output)
@@ -1,131 +1,575 @@
 import os
+import gzip
+import html
+import json
+import time
+import posixpath
 import socket
 import signal
+import struct
 import logging
 import asyncio
 import mimetypes
 import selectors
+import collections
 import multiprocessing as mp
 
+from stat import S_ISREG
 from time import strftime, gmtime
-from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote, unquote
 from optparse import OptionParser
 
+from accesslog import AccessLog, Record, BUFFER_SIZE as ACCESS_LOG_BUFFER_SIZE, FORMATS as ACCESS_LOG_FORMATS
+from stats import ServerStats, WorkerStats, SLOT_SIZE, RETIRED_SLOT
+from proxy import UpstreamError, parse_route
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 HEADER_END = '\r\n\r\n'
 LINE_END = '\r\n'
 HTTP_VERSION_STRING = 'HTTP/1.1'
 
 HEADERS_EMPTY_CONTENT = [
     'Content-Type: text/plain; charset=utf-8',
-    'Content-Length: {}'
+    'Content-Length: 0',
+    'Connection: close'
 ]
 
 
+WorkerHandle = collections.namedtuple('WorkerHandle', ['process', 'ready', 'slot'])
+FileInfo = collections.namedtuple('FileInfo', ['size', 'mtime', 'etag', 'last_modified'])
+Resolved = collections.namedtuple('Resolved', ['path', 'content_type', 'info'])
+Body = collections.namedtuple('Body', ['path', 'offset', 'count', 'data'], defaults=(None,))
+
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_SIZE = 256
+COMPRESS_MAX_SIZE = 4 * 1024 * 1024
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+}
+ENCODING_SUFFIXES = {
+    'br': '.br',
+    'gzip': '.gz',
+}
+COMPRESSORS = {
+    'gzip': lambda data: gzip.compress(data, COMPRESS_LEVEL, mtime=0),
+}
+if brotli is not None:
+    COMPRESSORS['br'] = lambda data: brotli.compress(data, quality=COMPRESS_LEVEL)
+
+LISTEN_BACKLOG = 100
+KEEPALIVE_TIMEOUT = 15
+STATUS_PATH = '/server-status'
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+RESOLVE_TTL = 1.0
+RESOLVE_CACHE_SIZE = 10000
+FILE_CACHE_SIZE = 64 * 1024 * 1024
+SEND_CHUNK_SIZE = 64 * 1024
+SENDFILE_CHUNK_SIZE = 1024 * 1024
+SEND_TIMEOUT = 30
+WRITE_BUFFER_HIGH = 64 * 1024
+WRITE_BUFFER_LOW = 16 * 1024
+MAX_BUFFERED = 32 * 1024 * 1024
+LOOP_KINDS = ('auto', 'uvloop', 'asyncio')
+SUPERVISOR_INTERVAL = 0.5
+READY_TIMEOUT = 10
+# autoscaling: pending connections in the accept queue and supervisor ticks
+SCALE_UP_QUEUE = 16
+SCALE_UP_TICKS = 2
+SCALE_DOWN_TICKS = 60
+
+
 class Codes:
     OK = 200
+    PARTIAL_CONTENT = 206
+    NOT_MODIFIED = 304
     BAD_REQUEST = 400
     FORBIDDEN = 403
     NOT_FOUND = 404
     NOT_ALLOWED = 405
+    RANGE_NOT_SATISFIABLE = 416
     SERVER_ERROR = 500
+    BAD_GATEWAY = 502
+    SERVICE_UNAVAILABLE = 503
+    GATEWAY_TIMEOUT = 504
 
     description = {
         OK: 'OK',
+        PARTIAL_CONTENT: 'Partial Content',
+        NOT_MODIFIED: 'Not Modified',
         BAD_REQUEST: 'Bad Request',
         FORBIDDEN: 'Forbidden',
         NOT_FOUND: 'Not Found',
         NOT_ALLOWED: 'Method Not Allowed',
+        RANGE_NOT_SATISFIABLE: 'Range Not Satisfiable',
         SERVER_ERROR: 'Internal Server Error',
+        BAD_GATEWAY: 'Bad Gateway',
+        SERVICE_UNAVAILABLE: 'Service Unavailable',
+        GATEWAY_TIMEOUT: 'Gateway Timeout',
     }
 
     def to_response_line(self, code):
         return ' '.join([HTTP_VERSION_STRING, str(code), self.description[code]])
 
 
-_workers = list()
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class FileCache:
+    """Compressed files and listings of one worker, least recently used
+    entries are evicted once the data takes more than `limit` bytes. An
+    entry larger than the whole limit is not kept."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, version):
+        """Data cached for the key under this version or None."""
+        cached = self._entries.get(key)
+        if cached is None or cached[0] != version:
+            return None
+        self._entries.move_to_end(key)
+        return cached[1]
+
+    def put(self, key, version, data):
+        cached = self._entries.pop(key, None)
+        if cached is not None:
+            self.size -= len(cached[1])
+        if len(data) > self.limit:
+            return
+        self._entries[key] = (version, data)
+        self.size += len(data)
+        while self.size > self.limit:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class SendBudget:
+    """Caps the response bytes one worker keeps in transport write buffers.
+    A connection holds the budget of its chunks until its transport has
+    passed them to the socket, a chunk waits until enough of the budget is
+    released by other connections, so slow clients can not pin unbounded
+    memory."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._released = asyncio.Event()
+
+    def available(self, size):
+        # a chunk larger than the whole budget still goes out alone
+        return not self.used or self.used + size <= self.limit
+
+    async def acquire(self, size):
+        while not self.available(size):
+            self._released.clear()
+            await self._released.wait()
+        self.used += size
+
+    def release(self, size):
+        self.used -= size
+        self._released.set()
+
+
+_file_cache = FileCache(FILE_CACHE_SIZE)
+_path_cache = dict()
+_routes = list()
+_connections = set()
+_idle_connections = set()
+_draining = False
+_access_log = None
+_send_budget = None
+_server_stats = None
+# replaced by the worker slot of the shared stats in _serve
+_worker_stats = WorkerStats(memoryview(bytearray(SLOT_SIZE * 8)).cast('Q'), 0)
+
+
+class Supervisor:
+    """Master process: owns the listening socket, keeps the workers alive,
+    reloads them on SIGHUP and scales their number by the accept queue."""
+
+    def __init__(self, sock, min_workers, max_workers, stats):
+        self.sock = sock
+        self.stats = stats
+        self.free_slots = list(range(stats.slots - 1, RETIRED_SLOT, -1))
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.target = min_workers
+        self.workers = list()
+        self.retiring = dict()
+        self.busy_ticks = 0
+        self.idle_ticks = 0
+        self.reload_requested = False
+        self.stop_requested = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._request_reload)
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGTERM, self._request_stop)
+        logging.info('Master %s starting %s workers.', os.getpid(), self.target)
+        self.workers = [self._spawn() for _ in range(self.target)]
+        while True:
+            time.sleep(SUPERVISOR_INTERVAL)
+            # a group-wide SIGTERM reaches the workers too, do not respawn them
+            if self.stop_requested:
+                break
+            if self.reload_requested:
+                self.reload_requested = False
+                self._reload()
+            self._reap()
+            if self.max_workers > self.min_workers:
+                self._scale()
+        self._shutdown()
+
+    def _request_reload(self, unused1, unused2):
+        self.reload_requested = True
+
+    def _request_stop(self, unused1, unused2):
+        logging.info('Termination request received, shutting down workers.')
+        self.stop_requested = True
+
+    def _spawn(self):
+        if self.free_slots:
+            slot = self.free_slots.pop()
+        else:
+            logging.warning('No free stats slot, the new worker is counted as retired.')
+            slot = RETIRED_SLOT
+        ready = mp.Event()
+        worker = mp.Process(target=_serve, kwargs=dict(sock=self.sock, ready=ready, slot=slot))
+        worker.daemon = True
+        worker.start()
+        return WorkerHandle(worker, ready, slot)
+
+    def _release(self, handle):
+        handle.process.join()
+        if handle.slot != RETIRED_SLOT:
+            self.stats.retire(handle.slot)
+            self.free_slots.append(handle.slot)
+
+    def _retire(self, handle):
+        if handle.process.is_alive():
+            os.kill(handle.process.pid, signal.SIGTERM)
+        self.retiring[handle] = time.monotonic() + drain_timeout + 1
+
+    def _reload(self):
+        logging.info('Reload requested, starting %s new workers.', len(self.workers))
+        fresh = [self._spawn() for _ in self.workers]
+        deadline = time.monotonic() + READY_TIMEOUT
+        for handle in fresh:
+            if not handle.ready.wait(max(deadline - time.monotonic(), 0)):
+                logging.error('New workers are not ready, keeping the old ones.')
+                for failed in fresh:
+                    self._retire(failed)
+                return
+        for handle in self.workers:
+            self._retire(handle)
+        self.workers = fresh
+
+    def _reap(self):
+        for handle in list(self.workers):
+            if not handle.process.is_alive():
+                logging.error('Worker %s died with exit code %s, respawning.',
+                              handle.process.pid, handle.process.exitcode)
+                self.workers.remove(handle)
+                self._release(handle)
+        while len(self.workers) < self.target:
+            self.workers.append(self._spawn())
+        now = time.monotonic()
+        for handle, deadline in list(self.retiring.items()):
+            if handle.process.is_alive() and now > deadline:
+                logging.warning('Worker %s did not drain in time, killing it.', handle.process.pid)
+                handle.process.kill()
+            if not handle.process.is_alive():
+                self._release(handle)
+                del self.retiring[handle]
+
+    def _scale(self):
+        depth = _accept_queue_depth(self.sock)
+        if depth is None:
+            return
+        self.busy_ticks = self.busy_ticks + 1 if depth >= SCALE_UP_QUEUE else 0
+        self.idle_ticks = self.idle_ticks + 1 if depth == 0 else 0
+        if self.busy_ticks >= SCALE_UP_TICKS and self.target < self.max_workers:
+            self.target += 1
+            self.busy_ticks = 0
+            logging.info('Accept queue depth %s, scaling up to %s workers.', depth, self.target)
+            self.workers.append(self._spawn())
+        elif self.idle_ticks >= SCALE_DOWN_TICKS and self.target > self.min_workers:
+            self.target -= 1
+            self.idle_ticks = 0
+            logging.info('Accept queue is idle, scaling down to %s workers.', self.target)
+            self._retire(self.workers.pop())
 
+    def _shutdown(self):
+        self.target = 0
+        for handle in self.workers:
+            self._retire(handle)
+        self.workers = list()
+        while self.retiring:
+            self._reap()
+            time.sleep(0.1)
+        logging.info('Master %s stopped.', os.getpid())
 
-def _serve(sock):
-    selector = selectors.EpollSelector()
-    loop = asyncio.SelectorEventLoop(selector)
+
+def _serve(sock, ready=None, slot=None):
+    global _access_log, _worker_stats, _send_budget
+    # the master coordinates the shutdown and reloads
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    if access_log_path:
+        _access_log = AccessLog(access_log_path, access_log_format, access_log_buffer)
+    if _server_stats is not None and slot is not None:
+        _worker_stats = _server_stats.worker(slot)
+        _worker_stats.start()
+    loop = _new_event_loop(loop_kind)
     asyncio.set_event_loop(loop)
-    coro = asyncio.start_server(_handle_connection, sock=sock)
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=executor_workers))
+    _send_budget = SendBudget(max_buffered)
+    coro = asyncio.start_server(_handle_tracked_connection, sock=sock, backlog=listen_backlog)
     server = loop.run_until_complete(coro)
-    loop.add_signal_handler(signal.SIGTERM, loop.stop)
-    loop.add_signal_handler(signal.SIGINT, loop.stop)
-    logging.info('Starting server worker at http://{}:{}'.format(address, port))
+
+    def drain():
+        global _draining
+        if not _draining:
+            _draining = True
+            loop.create_task(_drain(server))
+
+    loop.add_signal_handler(signal.SIGTERM, drain)
+    logging.info('Starting server worker at http://{}:{} ({} loop)'.format(
+        address, port, type(loop).__module__.split('.')[0]))
+    if ready is not None:
+        ready.set()
     try:
         loop.run_forever()
     finally:
         logging.info('Closing server worker...')
         server.close()
-        coro.close()
-        loop.run_until_complete(coro)
+        loop.close()
+        if _access_log is not None:
+            _access_log.close()
+
+
+def _new_event_loop(kind):
+    if kind in ('auto', 'uvloop') and uvloop is not None:
+        return uvloop.new_event_loop()
+    if kind == 'uvloop':
+        logging.warning('uvloop is not installed, falling back to the asyncio loop.')
+    return asyncio.SelectorEventLoop(selectors.EpollSelector())
 
 
-def _terminate(unused1, unused2):
-    logging.info('Termination request received, shutting down workers.')
-    for worker in _workers:
-        worker.terminate()
+async def _drain(server):
+    logging.info('Worker %s draining %s connections.', os.getpid(), len(_connections))
+    server.close()
+    # keep-alive connections waiting for the next request have nothing in flight
+    for task in _idle_connections:
+        task.cancel()
+    if _connections:
+        await asyncio.wait(set(_connections), timeout=drain_timeout)
+    asyncio.get_event_loop().stop()
+
+
+def _accept_queue_depth(sock):
+    """Connections waiting in the accept queue: for a listening socket Linux
+    reports it in tcpi_unacked of TCP_INFO."""
+    try:
+        tcp_info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except (AttributeError, OSError):
+        return None
+    return struct.unpack_from('I', tcp_info, 24)[0]
 
 
 def _socket():
     _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     _sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    _sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if send_buffer:
+        # inherited by the accepted sockets
+        _sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
     _sock.bind((address, port))
+    _sock.listen(listen_backlog)
     return _sock
 
 
 def start():
-    signal.signal(signal.SIGINT, _terminate)
-    signal.signal(signal.SIGTERM, _terminate)
-    for _ in range(workers_count):
-        sock = _socket()
-        worker = mp.Process(target=_serve, kwargs=dict(sock=sock))
-        worker.daemon = True
-        worker.start()
-        _workers.append(worker)
+    global _server_stats
+    # twice the workers: old and new ones overlap during a reload
+    _server_stats = ServerStats(2 * max_workers_count + 1)
+    Supervisor(_socket(), workers_count, max_workers_count, _server_stats).run()
 
-    for worker in _workers:
-        worker.join()
+
+async def _handle_tracked_connection(reader, writer):
+    task = asyncio.current_task()
+    _connections.add(task)
+    _worker_stats.connection_opened()
+    if not tcp_nodelay:
+        # both loops enable TCP_NODELAY on accepted sockets by default
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0)
+    writer.transport.set_write_buffer_limits(high=write_buffer_high, low=write_buffer_low)
+    try:
+        await _handle_connection(reader, writer)
+    finally:
+        _connections.discard(task)
+        _worker_stats.connection_closed()
 
 
 async def _handle_connection(reader, writer):
-    address = writer.get_extra_info('peername')
-    logging.info('Accepted connection from %s.', address)
-    raw_request = None
-    content = None
-    headers = HEADERS_EMPTY_CONTENT
-    while True:
-        try:
-            raw_request = await reader.readuntil(HEADER_END.encode())
-            if raw_request:
+    peername = writer.get_extra_info('peername')
+    remote = peername[0] if peername else '-'
+    task = asyncio.current_task()
+    try:
+        while True:
+            _idle_connections.add(task)
+            try:
+                raw_request = await asyncio.wait_for(reader.readuntil(HEADER_END.encode()), KEEPALIVE_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
                 break
-        except asyncio.IncompleteReadError:
-            break
+            finally:
+                _idle_connections.discard(task)
+            keep_alive = await _handle_request(raw_request, reader, writer, remote)
+            if not keep_alive or _draining:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def _handle_request(raw_request, reader, writer, remote):
+    started = time.time()
+    body = None
+    keep_alive = False
+    request_headers = dict()
     try:
-        method, resource, response_headers = _parse_request(raw_request)
+        method, resource, request_headers, response_headers = _parse_request(raw_request)
+        keep_alive = _is_keep_alive(request_headers)
+        upstream = _match_route(resource)
+        if upstream is not None and not _is_plain_target(resource):
+            # the upstream could resolve the target to another path than the route
+            code, headers, keep_alive = Codes.BAD_REQUEST, HEADERS_EMPTY_CONTENT, False
+            writer.write(_create_header_lines(code, headers))
+            await _drain_writer(writer)
+            _log_access(started, remote, raw_request, request_headers, code, 0)
+            return False
+        if upstream is not None:
+            code, size, keep_alive = await _proxy_request(
+                upstream, method, resource, request_headers, reader, writer, remote, keep_alive)
+            _log_access(started, remote, raw_request, request_headers, code, size)
+            return keep_alive
+        if keep_alive and _has_body(request_headers):
+            # the body is not read, it must not be taken for the next request
+            keep_alive = False
+            response_headers = ['Connection: close' if header.startswith('Connection:') else header
+                                for header in response_headers]
         path = _parse_path(resource)
-        if method in ['GET', 'HEAD']:
-            code, headers = _prepare_response(path, response_headers)
-            if method == 'GET' and code == Codes.OK:
-                with open(os.path.join(root_path, path), 'rb') as fd:
-                    try:
-                        content = await _read_file(fd)
-                    except IOError:
-                        logging.error('Error on reading requested file %s contents.', path)
-                        raise
+        if method in ['GET', 'HEAD'] and status_path and '/' + path == status_path:
+            code, headers, body = _prepare_status_response(response_headers)
+            if method == 'HEAD':
+                body = None
+        elif method in ['GET', 'HEAD']:
+            listing = autoindex and unquote(resource).split('?')[0].endswith('/')
+            code, headers, body = await _prepare_response(path, request_headers, response_headers, listing)
+            if method == 'HEAD':
+                body = None
         else:
             code = Codes.NOT_ALLOWED
+            headers = response_headers + ['Content-Length: 0']
     except Exception as e:
         logging.exception(e)
         code = Codes.SERVER_ERROR
+        headers = HEADERS_EMPTY_CONTENT
+        keep_alive = False
+    if body and body.data is None:
+        # without corking the sendfile body waits for the delayed ACK of the
+        # header segment on keep-alive connections
+        _set_cork(writer, True)
     writer.write(_create_header_lines(code, headers))
-    if content:
-        writer.write(content)
-    await writer.drain()
-    writer.close()
+    try:
+        if body:
+            await _send_file(writer, body)
+        await _drain_writer(writer)
+    except asyncio.TimeoutError:
+        logging.warning('Send timeout, dropping slow client %s.', remote)
+        writer.transport.abort()
+        _log_access(started, remote, raw_request, request_headers, code, 0)
+        return False
+    except IOError:
+        logging.error('Error on sending requested file %s contents.', body.path if body else None)
+        _log_access(started, remote, raw_request, request_headers, code, 0)
+        return False
+    _log_access(started, remote, raw_request, request_headers, code, body.count if body else 0)
+    return keep_alive
+
+
+def _match_route(resource):
+    """Matches the prefixes against the decoded path without dot segments,
+    so neither encoding nor /./ and /../ move a request in or out of a route."""
+    if not _routes:
+        return None
+    path = _route_path(resource)
+    for prefix, upstream in _routes:
+        if path.startswith(prefix):
+            return upstream
+    return None
+
+
+def _route_path(resource):
+    path = unquote(resource.split('?', 1)[0])
+    normalized = '/' + posixpath.normpath('/' + path).lstrip('/')
+    if path.endswith('/') and normalized != '/':
+        normalized += '/'
+    return normalized
+
+
+def _is_plain_target(resource):
+    """A target forwarded as is must not have dot segments or encoded separators."""
+    path = resource.split('?', 1)[0]
+    lowered = path.lower()
+    if '%2f' in lowered or '%5c' in lowered or '\\' in path:
+        return False
+    segments = unquote(path).split('/')
+    return '.' not in segments and '..' not in segments
+
+
+async def _proxy_request(upstream, method, resource, request_headers, reader, writer, remote, keep_alive):
+    try:
+        return await upstream.forward(method, resource, request_headers, remote, reader, writer, keep_alive)
+    except UpstreamError as e:
+        logging.error('Proxy %s %s to %s: %s', method, resource, upstream, e)
+        # the request body may be left unread, so the connection is closed
+        writer.write(_create_header_lines(e.status, HEADERS_EMPTY_CONTENT))
+        await _drain_writer(writer)
+        return e.status, 0, False
+
+
+def _log_access(started, remote, raw_request, request_headers, code, size):
+    _worker_stats.request_done(code, size, time.time() - started)
+    if _access_log is None:
+        return
+    _access_log.log(Record(
+        started,
+        remote,
+        raw_request.split(LINE_END.encode(), 1)[0],
+        code,
+        size,
+        request_headers.get('Referer'),
+        request_headers.get('User-Agent'),
+        time.time() - started,
+    ))
 
 
 def _parse_request(raw_request):
@@ -139,14 +583,38 @@ def _parse_request(raw_request):
         raise Exception('Wrong request line: %s' % request_line)
     method, resource = request_args[:2]
     headers = _parse_headers(header_lines)
-    close_connection = headers.get('Connection', 'close') == 'close'
-    connection = 'close' if close_connection else 'keep-alive'
+    connection = 'keep-alive' if _is_keep_alive(headers) else 'close'
     response_headers = [
         'Date: {}'.format(strftime("%a, %d %b %Y %H:%M:%S GMT", gmtime())),
         'Server: OTUServer',
         'Connection: {}'.format(connection)
     ]
-    return method, resource, response_headers
+    return method, resource, headers, response_headers
+
+
+def _prepare_status_response(headers):
+    report = _server_stats.report() if _server_stats is not None else dict()
+    report.update(master=os.getppid(), worker=os.getpid())
+    data = json.dumps(report, indent=2).encode()
+    headers.extend([
+        'Cache-Control: no-store',
+        'Content-Type: application/json',
+        'Content-Length: {}'.format(len(data))
+    ])
+    return Codes.OK, headers, Body(STATUS_PATH, 0, len(data), data)
+
+
+def _is_keep_alive(headers):
+    return headers.get('Connection', 'close').lower() != 'close'
+
+
+def _has_body(headers):
+    if 'Transfer-Encoding' in headers:
+        return True
+    try:
+        return int(headers.get('Content-Length', 0)) != 0
+    except ValueError:
+        return True
 
 
 def _parse_headers(header_lines):
@@ -154,8 +622,8 @@ def _parse_headers(header_lines):
     for line in header_lines:
         line = line.strip()
         if line:
-            header, value = line.split(': ')
-            out[header] = value
+            header, value = line.split(':', 1)
+            out[header.strip().title()] = value.strip()
     return out
 
 
@@ -171,26 +639,260 @@ def _parse_path(resource):
     return path
 
 
-def _prepare_response(document_path, headers):
-    normpath = os.path.normpath(document_path)
-    full_path = os.path.join(root_path, normpath)
-    if '/..' in full_path:
-        clear_path = os.path.normpath(full_path)
-        if not clear_path.startswith(root_path):
-            return Codes.FORBIDDEN, headers
-    file_exists = os.path.exists(full_path)
-    if not file_exists:
-        return Codes.NOT_FOUND, headers
-
-    path = os.path.join(root_path, document_path)
-    content_length = os.path.getsize(path)
-    _, ext = os.path.splitext(path)
-    content_type = mimetypes.types_map[ext.lower()]
+async def _prepare_response(document_path, request_headers, headers, listing=False):
+    resolved = _resolve(document_path)
+    if resolved.path is None:
+        return Codes.FORBIDDEN, headers + ['Content-Length: 0'], None
+    if resolved.info is None:
+        directory = os.path.dirname(resolved.path)
+        if listing and os.path.isdir(directory):
+            url_path = os.path.dirname(os.path.normpath(document_path))
+            return await _prepare_listing(directory, url_path, headers)
+        return Codes.NOT_FOUND, headers + ['Content-Length: 0'], None
+
+    content_type = resolved.content_type
+    encoding, info, body = await _select_representation(document_path, resolved, request_headers)
+    headers.extend([
+        'ETag: {}'.format(info.etag),
+        'Last-Modified: {}'.format(info.last_modified),
+    ])
+    if is_compressible(content_type):
+        headers.append('Vary: Accept-Encoding')
+    if _is_not_modified(info, request_headers):
+        return Codes.NOT_MODIFIED, headers, None
+
     headers.extend([
-        'Content-Length: {}'.format(content_length),
+        'Accept-Ranges: bytes',
         'Content-Type: {}'.format(content_type)
     ])
-    return Codes.OK, headers
+    if encoding:
+        headers.append('Content-Encoding: {}'.format(encoding))
+    byte_range = None
+    if 'Range' in request_headers and _if_range_matches(info, request_headers):
+        try:
+            byte_range = _parse_range(request_headers['Range'], info.size)
+        except RangeNotSatisfiable:
+            headers.extend([
+                'Content-Range: bytes */{}'.format(info.size),
+                'Content-Length: 0'
+            ])
+            return Codes.RANGE_NOT_SATISFIABLE, headers, None
+    if byte_range is None:
+        headers.append('Content-Length: {}'.format(info.size))
+        return Codes.OK, headers, body
+
+    offset, count = byte_range
+    headers.extend([
+        'Content-Range: bytes {}-{}/{}'.format(offset, offset + count - 1, info.size),
+        'Content-Length: {}'.format(count)
+    ])
+    return Codes.PARTIAL_CONTENT, headers, body._replace(offset=offset, count=count)
+
+
+async def _prepare_listing(directory, url_path, headers):
+    mtime = os.stat(directory).st_mtime_ns
+    key = ('autoindex', directory)
+    data = _file_cache.get(key, mtime)
+    _worker_stats.cache_lookup(data is not None)
+    if data is None:
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(None, _render_listing, directory, url_path)
+        _file_cache.put(key, mtime, data)
+    headers.extend([
+        'Content-Type: text/html; charset=utf-8',
+        'Content-Length: {}'.format(len(data))
+    ])
+    return Codes.OK, headers, Body(directory, 0, len(data), data)
+
+
+def _render_listing(directory, url_path):
+    """Runs in the executor: scandir of a big directory would stall the loop.
+    The result is cached until the directory mtime changes."""
+    entries = list()
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                stat = entry.stat()
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            entries.append((not is_dir, entry.name, is_dir, stat.st_size, stat.st_mtime))
+    entries.sort()
+    title = html.escape('/{}/'.format(url_path) if url_path else '/')
+    rows = ['<tr><td><a href="../">../</a></td><td></td><td></td></tr>'] if url_path else []
+    for _, name, is_dir, size, mtime in entries:
+        suffix = '/' if is_dir else ''
+        rows.append('<tr><td><a href="{}">{}</a></td><td>{}</td><td>{}</td></tr>'.format(
+            quote(name) + suffix,
+            html.escape(name) + suffix,
+            strftime('%Y-%m-%d %H:%M', gmtime(mtime)),
+            '-' if is_dir else size,
+        ))
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>Index of {0}</title></head>'
+        '<body><h1>Index of {0}</h1><table>{1}</table></body></html>'
+    ).format(title, ''.join(rows)).encode()
+
+
+async def _select_representation(document_path, resolved, request_headers):
+    """Picks the body to send for the negotiated Content-Encoding: a fresh
+    precompressed sibling file, a compressed copy from the worker cache or
+    the file itself."""
+    path, info = resolved.path, resolved.info
+    if not is_compressible(resolved.content_type) or info.size < COMPRESS_MIN_SIZE:
+        return None, info, Body(path, 0, info.size)
+    for encoding in _accepted_encodings(request_headers.get('Accept-Encoding', '')):
+        etag = '{}-{}"'.format(info.etag[:-1], encoding)
+        sibling = _resolve(document_path + ENCODING_SUFFIXES[encoding])
+        if sibling.info and sibling.info.mtime >= info.mtime:
+            encoded_info = info._replace(size=sibling.info.size, etag=etag)
+            return encoding, encoded_info, Body(sibling.path, 0, sibling.info.size)
+        if encoding in COMPRESSORS and info.size <= COMPRESS_MAX_SIZE:
+            data = await _compressed_content(path, info, encoding)
+            return encoding, info._replace(size=len(data), etag=etag), Body(path, 0, len(data), data)
+    return None, info, Body(path, 0, info.size)
+
+
+def _accepted_encodings(accept_encoding):
+    """Returns encodings we can serve, in the server preference order,
+    skipping the ones the client refused with q=0."""
+    accepted = set()
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return [
+        encoding for encoding in ENCODING_SUFFIXES
+        if encoding in accepted or '*' in accepted
+    ]
+
+
+async def _compressed_content(path, info, encoding):
+    key = (path, encoding)
+    data = _file_cache.get(key, info.etag)
+    _worker_stats.cache_lookup(data is not None)
+    if data is not None:
+        return data
+    loop = asyncio.get_event_loop()
+    data = await loop.run_in_executor(None, _compress_file, path, encoding)
+    _file_cache.put(key, info.etag, data)
+    return data
+
+
+def _compress_file(path, encoding):
+    with open(path, 'rb') as fd:
+        return COMPRESSORS[encoding](fd.read())
+
+
+def is_compressible(content_type):
+    return content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES
+
+
+def _resolve(document_path):
+    """Maps a URL path to the file, its MIME type and stat results. Results,
+    the negative ones too, are cached for RESOLVE_TTL seconds, so a hot file
+    costs one dict lookup instead of realpath and stat syscalls."""
+    now = time.monotonic()
+    cached = _path_cache.get(document_path)
+    _worker_stats.cache_lookup(bool(cached and cached[0] > now))
+    if cached and cached[0] > now:
+        return cached[1]
+
+    full_path = os.path.realpath(os.path.join(root_path, document_path))
+    if full_path != root_path and not full_path.startswith(os.path.join(root_path, '')):
+        resolved = Resolved(None, None, None)
+    else:
+        _, ext = os.path.splitext(full_path)
+        content_type = mimetypes.types_map.get(ext.lower(), DEFAULT_CONTENT_TYPE)
+        resolved = Resolved(full_path, content_type, _file_info(full_path))
+    if len(_path_cache) >= RESOLVE_CACHE_SIZE:
+        _path_cache.clear()
+    _path_cache[document_path] = (now + RESOLVE_TTL, resolved)
+    return resolved
+
+
+def _file_info(full_path):
+    """FileInfo of a regular file, None when there is no such file."""
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        return None
+    if not S_ISREG(stat.st_mode):
+        return None
+    return FileInfo(
+        size=stat.st_size,
+        mtime=stat.st_mtime_ns,
+        etag='"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size),
+        last_modified=formatdate(stat.st_mtime, usegmt=True),
+    )
+
+
+def _is_not_modified(info, request_headers):
+    if_none_match = request_headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or any(_strip_weak(tag) == info.etag for tag in tags)
+    if_modified_since = request_headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        since = _parse_http_date(if_modified_since)
+        return since is not None and info.mtime // 10 ** 9 <= since
+    return False
+
+
+def _if_range_matches(info, request_headers):
+    if_range = request_headers.get('If-Range')
+    if if_range is None:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == info.etag
+    since = _parse_http_date(if_range)
+    return since is not None and info.mtime // 10 ** 9 <= since
+
+
+def _parse_range(value, size):
+    """Returns (offset, count) of a single byte range or None when the header
+    should be ignored and the whole file served."""
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    start, _, end = spec.strip().partition('-')
+    try:
+        if start:
+            first = int(start)
+            last = int(end) if end else size - 1
+        else:
+            suffix = int(end)
+            if suffix == 0:
+                raise RangeNotSatisfiable(value)
+            first = max(size - suffix, 0)
+            last = size - 1
+    except ValueError:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable(value)
+    if first > last:
+        return None
+    last = min(last, size - 1)
+    return first, last - first + 1
+
+
+def _strip_weak(tag):
+    return tag[2:] if tag.startswith('W/') else tag
+
+
+def _parse_http_date(value):
+    try:
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError):
+        return None
 
 
 def _create_header_lines(http_code, headers):
@@ -199,17 +901,121 @@ def _create_header_lines(http_code, headers):
     return response_string.encode()
 
 
-def _read_file(file):
+async def _send_file(writer, body):
+    if body.data is not None:
+        await _send_data(writer, memoryview(body.data)[body.offset:body.offset + body.count])
+        return
+    try:
+        await _drain_writer(writer)
+        with open(body.path, 'rb') as fd:
+            try:
+                await _sendfile(writer, fd, body.offset, body.count)
+            except NotImplementedError:
+                # uvloop has no loop.sendfile
+                await _send_file_chunks(writer, fd, body.offset, body.count)
+    finally:
+        _set_cork(writer, False)
+
+
+async def _sendfile(writer, fd, offset, count):
+    """sendfile keeps the data in the page cache, only the progress of every
+    chunk is bounded by the send timeout."""
     loop = asyncio.get_event_loop()
-    return loop.run_in_executor(None, file.read)
+    while count > 0:
+        sent = await asyncio.wait_for(
+            loop.sendfile(writer.transport, fd, offset, min(count, SENDFILE_CHUNK_SIZE)), send_timeout)
+        if not sent:
+            break
+        offset += sent
+        count -= sent
+
+
+async def _send_data(writer, data):
+    """drain() returns while the transport still buffers up to the low
+    watermark, so the budget is given back only as far as the buffer has
+    shrunk and the rest once it is flushed."""
+    transport = writer.transport
+    held = 0
+    try:
+        for start in range(0, len(data), SEND_CHUNK_SIZE):
+            chunk = data[start:start + SEND_CHUNK_SIZE]
+            if held and not _send_budget.available(len(chunk)):
+                # do not wait for other connections while holding budget
+                await _flush_writer(writer)
+                _send_budget.release(held)
+                held = 0
+            await _send_budget.acquire(len(chunk))
+            held += len(chunk)
+            writer.write(chunk)
+            await _drain_writer(writer)
+            buffered = transport.get_write_buffer_size()
+            if buffered < held:
+                _send_budget.release(held - buffered)
+                held = buffered
+        if held:
+            await _flush_writer(writer)
+    finally:
+        _send_budget.release(held)
+
+
+def _drain_writer(writer):
+    return asyncio.wait_for(writer.drain(), send_timeout)
+
+
+async def _flush_writer(writer):
+    """Waits until the transport buffer is empty: with both watermarks at
+    zero drain() returns only then."""
+    transport = writer.transport
+    if not transport.get_write_buffer_size():
+        return
+    transport.set_write_buffer_limits(high=0, low=0)
+    try:
+        await _drain_writer(writer)
+    finally:
+        transport.set_write_buffer_limits(high=write_buffer_high, low=write_buffer_low)
+
+
+def _set_cork(writer, enabled):
+    sock = writer.get_extra_info('socket')
+    if hasattr(socket, 'TCP_CORK') and sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(enabled))
+
+
+async def _send_file_chunks(writer, fd, offset, count):
+    loop = asyncio.get_event_loop()
+    fd.seek(offset)
+    while count > 0:
+        chunk = await loop.run_in_executor(None, fd.read, min(SEND_CHUNK_SIZE, count))
+        if not chunk:
+            break
+        count -= len(chunk)
+        await _send_data(writer, chunk)
 
 
 if __name__ == "__main__":
     parser = OptionParser()
     parser.add_option("-p", "--port", action="store", type=int, default=80)
     parser.add_option("-w", "--workers", action="store", type=int, default=64)
+    parser.add_option("-m", "--max-workers", action="store", type=int, default=0)
+    parser.add_option("-d", "--drain-timeout", action="store", type=float, default=10)
     parser.add_option("-r", "--rootdir", action="store", type=str, default='.')
     parser.add_option("-l", "--logfile", action="store", type=str, default='/tmp/httpd.log')
+    parser.add_option("-a", "--access-log", action="store", type=str, default=None)
+    parser.add_option("--access-log-format", action="store", type="choice",
+                      choices=ACCESS_LOG_FORMATS, default='combined')
+    parser.add_option("--access-log-buffer", action="store", type=int, default=ACCESS_LOG_BUFFER_SIZE)
+    parser.add_option("-i", "--autoindex", action="store_true", default=False)
+    parser.add_option("-s", "--status-path", action="store", type=str, default=STATUS_PATH)
+    parser.add_option("--send-timeout", action="store", type=float, default=SEND_TIMEOUT)
+    parser.add_option("--write-buffer-high", action="store", type=int, default=WRITE_BUFFER_HIGH)
+    parser.add_option("--write-buffer-low", action="store", type=int, default=WRITE_BUFFER_LOW)
+    parser.add_option("--max-buffered", action="store", type=int, default=MAX_BUFFERED)
+    parser.add_option("-P", "--proxy", action="append", type=str, default=[], metavar="PREFIX=HOST:PORT[,HOST:PORT][;OPTION=VALUE]")
+    parser.add_option("--loop", action="store", type="choice", choices=LOOP_KINDS, default='auto')
+    parser.add_option("--backlog", action="store", type=int, default=LISTEN_BACKLOG)
+    parser.add_option("--no-nodelay", action="store_false", dest="nodelay", default=True)
+    parser.add_option("--sndbuf", action="store", type=int, default=0)
+    parser.add_option("--executor-workers", action="store", type=int, default=None)
 
     opts, args = parser.parse_args()
     logging.basicConfig(filename=opts.logfile,
@@ -220,7 +1026,28 @@ if __name__ == "__main__":
     workers = min(mp.cpu_count(), opts.workers)
     address = '127.0.0.1'
     port = opts.port
-    root_path = os.path.abspath(opts.rootdir)
-    _prepare_response('root_path', root_path)
+    root_path = os.path.realpath(opts.rootdir)
     workers_count = workers
+    max_workers_count = max(workers, opts.max_workers)
+    drain_timeout = opts.drain_timeout
+    loop_kind = opts.loop
+    listen_backlog = opts.backlog
+    tcp_nodelay = opts.nodelay
+    send_buffer = opts.sndbuf
+    executor_workers = opts.executor_workers
+    access_log_path = opts.access_log
+    access_log_format = opts.access_log_format
+    access_log_buffer = opts.access_log_buffer
+    status_path = opts.status_path
+    autoindex = opts.autoindex
+    send_timeout = opts.send_timeout
+    write_buffer_high = opts.write_buffer_high
+    write_buffer_low = opts.write_buffer_low
+    max_buffered = opts.max_buffered
+    try:
+        routes = [parse_route(spec) for spec in opts.proxy]
+    except ValueError as e:
+        parser.error(str(e))
+    # the longest matching prefix wins
+    _routes.extend(sorted(routes, key=lambda route: len(route[0]), reverse=True))
     start()
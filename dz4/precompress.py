@@ -0,0 +1,68 @@
+import os
+import logging
+import mimetypes
+
+from optparse import OptionParser
+
+from httpd import COMPRESSORS, COMPRESS_MIN_SIZE, ENCODING_SUFFIXES, is_compressible
+
+
+def precompress(root, encodings, force=False):
+    written = skipped = 0
+    suffixes = tuple(ENCODING_SUFFIXES.values())
+    for dir_path, _, file_names in os.walk(root):
+        for name in file_names:
+            if name.endswith(suffixes):
+                continue
+            path = os.path.join(dir_path, name)
+            content_type, _ = mimetypes.guess_type(name)
+            if not content_type or not is_compressible(content_type):
+                continue
+            stat = os.stat(path)
+            if stat.st_size < COMPRESS_MIN_SIZE:
+                continue
+            for encoding in encodings:
+                target = path + ENCODING_SUFFIXES[encoding]
+                if not force and _is_fresh(target, stat):
+                    skipped += 1
+                    continue
+                _write_compressed(path, target, encoding, stat)
+                logging.info('%s -> %s', path, target)
+                written += 1
+    return written, skipped
+
+
+def _is_fresh(target, stat):
+    try:
+        return os.stat(target).st_mtime_ns >= stat.st_mtime_ns
+    except OSError:
+        return False
+
+
+def _write_compressed(path, target, encoding, stat):
+    with open(path, 'rb') as fd:
+        data = COMPRESSORS[encoding](fd.read())
+    tmp_path = target + '.tmp'
+    with open(tmp_path, 'wb') as fd:
+        fd.write(data)
+    # httpd serves a sibling only while it is not older than the source
+    os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(tmp_path, target)
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='%prog [options]  # writes .gz/.br siblings for text files')
+    parser.add_option("-r", "--rootdir", action="store", type=str, default='.')
+    parser.add_option("-e", "--encodings", action="store", type=str, default=','.join(sorted(COMPRESSORS)))
+    parser.add_option("-f", "--force", action="store_true", default=False)
+
+    opts, args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    requested = [encoding.strip() for encoding in opts.encodings.split(',') if encoding.strip()]
+    unsupported = [encoding for encoding in requested if encoding not in COMPRESSORS]
+    if unsupported:
+        parser.error('unsupported encodings: {} (brotli module installed?)'.format(', '.join(unsupported)))
+    written, skipped = precompress(os.path.abspath(opts.rootdir), requested, opts.force)
+    logging.info('Done: %s files written, %s up to date.', written, skipped)
@@ -0,0 +1,299 @@
+import re
+import time
+import asyncio
+import logging
+import itertools
+import collections
+
+BAD_GATEWAY = 502
+SERVICE_UNAVAILABLE = 503
+GATEWAY_TIMEOUT = 504
+
+HEADER_END = b'\r\n\r\n'
+LINE_END = b'\r\n'
+CHUNK_SIZE = 64 * 1024
+CONNECT_TIMEOUT = 5
+TIMEOUT = 30
+MAX_CONNECTIONS = 64
+IDLE_CONNECTIONS = 16
+IDLE_TIMEOUT = 30
+_CHUNK_SIZE_LINE = re.compile(rb'([0-9A-Fa-f]{1,16})[ \t]*(;[^\r\n]*)?\r\n')
+
+# request headers are title-cased by httpd._parse_headers
+HOP_BY_HOP = {
+    'Connection', 'Keep-Alive', 'Proxy-Authenticate', 'Proxy-Authorization',
+    'Te', 'Trailer', 'Transfer-Encoding', 'Upgrade', 'Expect',
+}
+OPTIONS = {
+    'connect_timeout': float,
+    'timeout': float,
+    'max_connections': int,
+    'idle_connections': int,
+}
+
+Response = collections.namedtuple('Response', ['status', 'reason', 'version', 'headers'])
+
+
+class UpstreamError(Exception):
+    """The upstream failed before any byte of its response reached the client,
+    so an error response can still be sent."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Upstream:
+    """Pool of upstream servers of one route: round robin between servers,
+    idle keep-alive connections for reuse and a cap of concurrent requests.
+    The objects are copied into every worker, so the limits are per worker."""
+
+    def __init__(self, servers, connect_timeout=CONNECT_TIMEOUT, timeout=TIMEOUT,
+                 max_connections=MAX_CONNECTIONS, idle_connections=IDLE_CONNECTIONS):
+        self.servers = servers
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.idle_connections = idle_connections
+        self._next = itertools.cycle(servers)
+        self._idle = {server: collections.deque() for server in servers}
+        self._limit = None
+
+    def __repr__(self):
+        return ','.join('{}:{}'.format(*server) for server in self.servers)
+
+    async def forward(self, method, target, headers, remote, client_reader, client_writer, keep_alive):
+        """Streams the request to an upstream server and its response back.
+        Returns (status, body bytes sent, keep the client connection alive)."""
+        if self._limit is None:
+            self._limit = asyncio.Semaphore(self.max_connections)
+        try:
+            await asyncio.wait_for(self._limit.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise UpstreamError(SERVICE_UNAVAILABLE, 'Too many concurrent requests to {}'.format(self))
+        try:
+            return await self._forward(method, target, headers, remote, client_reader, client_writer, keep_alive)
+        finally:
+            self._limit.release()
+
+    async def _forward(self, method, target, headers, remote, client_reader, client_writer, keep_alive):
+        request_framing = _request_framing(headers)
+        head = _request_head(method, target, headers, remote)
+        for attempt in range(2):
+            server, reader, writer, reused = await self._connect()
+            try:
+                writer.write(head)
+                if request_framing:
+                    await _relay_body(client_reader, writer, request_framing, self.timeout)
+                raw_response = await asyncio.wait_for(reader.readuntil(HEADER_END), self.timeout)
+                break
+            except asyncio.TimeoutError:
+                writer.close()
+                raise UpstreamError(GATEWAY_TIMEOUT, 'Upstream {}:{} timed out'.format(*server))
+            except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+                writer.close()
+                # an idle connection may have been closed by the upstream meanwhile
+                if reused and not request_framing and not attempt:
+                    continue
+                raise UpstreamError(BAD_GATEWAY, 'Upstream {}:{} failed: {!r}'.format(server[0], server[1], e))
+
+        try:
+            response = _parse_response(raw_response)
+            response_framing = _response_framing(method, response)
+        except ValueError as e:
+            writer.close()
+            raise UpstreamError(BAD_GATEWAY, 'Upstream {}:{} sent a malformed response: {!r}'.format(
+                server[0], server[1], e))
+        if response_framing == 'eof':
+            # the length is known only when the upstream closes, so the client can not be reused
+            keep_alive = False
+        upstream_alive = response_framing != 'eof' and _upstream_keep_alive(response)
+        client_writer.write(_response_head(response, response_framing, keep_alive))
+        try:
+            sent = await _relay_body(reader, client_writer, response_framing, self.timeout)
+        except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError) as e:
+            # the head is sent already, so the client only learns it from the cut connection
+            logging.warning('Proxy %s %s to %s:%s broke off: %r', method, target, server[0], server[1], e)
+            writer.close()
+            client_writer.transport.abort()
+            return response.status, 0, False
+        if upstream_alive:
+            self._release(server, reader, writer)
+        else:
+            writer.close()
+        return response.status, sent, keep_alive
+
+    async def _connect(self):
+        now = time.monotonic()
+        for _ in range(len(self.servers)):
+            server = next(self._next)
+            idle = self._idle[server]
+            while idle:
+                reader, writer, since = idle.pop()
+                if now - since < IDLE_TIMEOUT and not reader.at_eof() and not writer.is_closing():
+                    return server, reader, writer, True
+                writer.close()
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*server), self.connect_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                logging.warning('Upstream %s:%s is unavailable: %r', server[0], server[1], e)
+                continue
+            return server, reader, writer, False
+        raise UpstreamError(BAD_GATEWAY, 'No server of {} is available'.format(self))
+
+    def _release(self, server, reader, writer):
+        idle = self._idle[server]
+        if len(idle) < self.idle_connections:
+            idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+
+def parse_route(spec):
+    """PREFIX=HOST:PORT[,HOST:PORT...][;option=value...], for example
+    /method/=127.0.0.1:8080,127.0.0.1:8081;timeout=10;max_connections=32"""
+    prefix, _, rest = spec.partition('=')
+    servers_spec, *options_spec = rest.split(';')
+    if not prefix.startswith('/') or not servers_spec:
+        raise ValueError('Wrong route: {}'.format(spec))
+    servers = list()
+    for server in servers_spec.split(','):
+        host, _, port = server.strip().rpartition(':')
+        servers.append((host or '127.0.0.1', int(port)))
+    options = dict()
+    for option in options_spec:
+        name, _, value = option.partition('=')
+        name = name.strip()
+        if name not in OPTIONS:
+            raise ValueError('Unknown upstream option: {}'.format(name))
+        options[name] = OPTIONS[name](value)
+    return prefix, Upstream(servers, **options)
+
+
+def _request_framing(headers):
+    if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        return 'chunked'
+    length = int(headers.get('Content-Length', 0))
+    return length or None
+
+
+def _request_head(method, target, headers, remote):
+    chunked = headers.get('Transfer-Encoding', '').lower() == 'chunked'
+    lines = ['{} {} HTTP/1.1'.format(method, target)]
+    for name, value in headers.items():
+        if name in HOP_BY_HOP or name == 'X-Forwarded-For':
+            continue
+        if chunked and name == 'Content-Length':
+            # a chunked body with a length too would be framed differently upstream
+            continue
+        lines.append('{}: {}'.format(name, value))
+    forwarded_for = headers.get('X-Forwarded-For')
+    lines.append('X-Forwarded-For: {}'.format('{}, {}'.format(forwarded_for, remote) if forwarded_for else remote))
+    if chunked:
+        lines.append('Transfer-Encoding: chunked')
+    lines.append('Connection: keep-alive')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+
+def _parse_response(raw_response):
+    status_line, *header_lines = raw_response.decode('latin-1').split('\r\n')
+    version, status, *reason = status_line.split(' ', 2)
+    if not version.startswith('HTTP/') or not status.isdigit() or len(status) != 3:
+        raise ValueError('Wrong status line: {}'.format(status_line))
+    headers = list()
+    for line in header_lines:
+        if line:
+            name, _, value = line.partition(':')
+            headers.append((name.strip(), value.strip()))
+    return Response(int(status), reason[0] if reason else '', version, headers)
+
+
+def _header(response, name):
+    name = name.lower()
+    for header, value in response.headers:
+        if header.lower() == name:
+            return value
+    return None
+
+
+def _response_framing(method, response):
+    if method == 'HEAD' or response.status in (204, 304) or response.status < 200:
+        return None
+    if (_header(response, 'Transfer-Encoding') or '').lower() == 'chunked':
+        return 'chunked'
+    length = _header(response, 'Content-Length')
+    if length is not None:
+        if not length.isdigit():
+            raise ValueError('Wrong Content-Length: {}'.format(length))
+        return int(length) or None
+    return 'eof'
+
+
+def _upstream_keep_alive(response):
+    connection = (_header(response, 'Connection') or '').lower()
+    if response.version == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+
+def _response_head(response, framing, keep_alive):
+    lines = ['HTTP/1.1 {} {}'.format(response.status, response.reason)]
+    for name, value in response.headers:
+        if name.title() not in HOP_BY_HOP:
+            lines.append('{}: {}'.format(name, value))
+    if framing == 'chunked':
+        lines.append('Transfer-Encoding: chunked')
+    lines.append('Connection: {}'.format('keep-alive' if keep_alive else 'close'))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+async def _relay_body(reader, writer, framing, timeout):
+    """Copies a body framed by length, chunked encoding (relayed as-is) or
+    the end of the stream; returns the number of bytes copied."""
+    if not framing:
+        return 0
+    if framing == 'chunked':
+        return await _relay_chunked(reader, writer, timeout)
+    remaining = None if framing == 'eof' else framing
+    copied = 0
+    while remaining is None or remaining > 0:
+        size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+        data = await asyncio.wait_for(reader.read(size), timeout)
+        if not data:
+            if remaining is None:
+                break
+            raise asyncio.IncompleteReadError(b'', remaining)
+        writer.write(data)
+        await asyncio.wait_for(writer.drain(), timeout)
+        copied += len(data)
+        if remaining is not None:
+            remaining -= len(data)
+    return copied
+
+
+async def _relay_chunked(reader, writer, timeout):
+    """Every size line and chunk end is checked before it is copied, so bad
+    framing raises ValueError instead of reaching the other side."""
+    copied = 0
+    while True:
+        size_line = await asyncio.wait_for(reader.readuntil(LINE_END), timeout)
+        match = _CHUNK_SIZE_LINE.fullmatch(size_line)
+        if match is None:
+            raise ValueError('Wrong chunk size line: {!r}'.format(size_line[:64]))
+        size = int(match.group(1), 16)
+        writer.write(size_line)
+        if not size:
+            # trailers up to the empty line
+            while True:
+                line = await asyncio.wait_for(reader.readuntil(LINE_END), timeout)
+                writer.write(line)
+                if line == LINE_END:
+                    break
+            await asyncio.wait_for(writer.drain(), timeout)
+            return copied
+        copied += await _relay_body(reader, writer, size, timeout)
+        chunk_end = await asyncio.wait_for(reader.readexactly(len(LINE_END)), timeout)
+        if chunk_end != LINE_END:
+            raise ValueError('Wrong chunk end: {!r}'.format(chunk_end))
+        writer.write(chunk_end)
@@ -0,0 +1,119 @@
+import os
+import time
+import multiprocessing as mp
+
+STATUS_CODES = (200, 206, 304, 400, 403, 404, 405, 416, 500, 502, 503, 504)
+LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+PID = 0
+STARTED = 1
+ACTIVE = 2
+REQUESTS = 3
+BYTES_SENT = 4
+CACHE_HITS = 5
+CACHE_MISSES = 6
+STATUS_BASE = 7
+OTHER_STATUS = STATUS_BASE + len(STATUS_CODES)
+LATENCY_BASE = OTHER_STATUS + 1
+SLOT_SIZE = LATENCY_BASE + len(LATENCY_BUCKETS_MS) + 1
+
+_STATUS_INDEX = {code: STATUS_BASE + index for index, code in enumerate(STATUS_CODES)}
+
+# slot 0 keeps the counters of the workers that already exited
+RETIRED_SLOT = 0
+
+
+class WorkerStats:
+    """Counters of one worker in its own slot of the shared array. Only the
+    owning worker writes to the slot, so no locking is needed."""
+
+    def __init__(self, counters, slot):
+        self.counters = counters
+        self.base = slot * SLOT_SIZE
+
+    def start(self):
+        self.counters[self.base + PID] = os.getpid()
+        self.counters[self.base + STARTED] = int(time.time())
+
+    def connection_opened(self):
+        self.counters[self.base + ACTIVE] += 1
+
+    def connection_closed(self):
+        self.counters[self.base + ACTIVE] -= 1
+
+    def cache_lookup(self, hit):
+        self.counters[self.base + (CACHE_HITS if hit else CACHE_MISSES)] += 1
+
+    def request_done(self, code, size, duration):
+        counters = self.counters
+        base = self.base
+        counters[base + REQUESTS] += 1
+        counters[base + BYTES_SENT] += size
+        counters[base + _STATUS_INDEX.get(code, OTHER_STATUS)] += 1
+        milliseconds = duration * 1000
+        bucket = 0
+        for bucket, limit in enumerate(LATENCY_BUCKETS_MS):
+            if milliseconds <= limit:
+                break
+        else:
+            bucket = len(LATENCY_BUCKETS_MS)
+        counters[base + LATENCY_BASE + bucket] += 1
+
+
+class ServerStats:
+    """Shared memory counters of all workers, created by the master before
+    the workers are forked."""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.array = mp.RawArray('Q', slots * SLOT_SIZE)
+
+    def worker(self, slot):
+        return WorkerStats(memoryview(self.array).cast('B').cast('Q'), slot)
+
+    def retire(self, slot):
+        """Moves counters of an exited worker into the retired slot."""
+        array = self.array
+        base = slot * SLOT_SIZE
+        for index in range(REQUESTS, SLOT_SIZE):
+            array[RETIRED_SLOT * SLOT_SIZE + index] += array[base + index]
+        for index in range(SLOT_SIZE):
+            array[base + index] = 0
+
+    def report(self):
+        snapshot = list(self.array)
+        totals = [0] * SLOT_SIZE
+        workers = list()
+        for slot in range(self.slots):
+            counters = snapshot[slot * SLOT_SIZE:(slot + 1) * SLOT_SIZE]
+            for index in range(ACTIVE, SLOT_SIZE):
+                totals[index] += counters[index]
+            if slot != RETIRED_SLOT and counters[PID]:
+                worker = _describe(counters)
+                worker.update(slot=slot, pid=counters[PID], uptime=int(time.time()) - counters[STARTED])
+                workers.append(worker)
+        report = _describe(totals)
+        report['workers'] = workers
+        return report
+
+
+def _describe(counters):
+    hits, misses = counters[CACHE_HITS], counters[CACHE_MISSES]
+    status = {str(code): counters[_STATUS_INDEX[code]] for code in STATUS_CODES if counters[_STATUS_INDEX[code]]}
+    if counters[OTHER_STATUS]:
+        status['other'] = counters[OTHER_STATUS]
+    latency = dict()
+    for bucket, limit in enumerate(LATENCY_BUCKETS_MS + ('+Inf',)):
+        latency['<={}'.format(limit)] = counters[LATENCY_BASE + bucket]
+    return {
+        'active_connections': counters[ACTIVE],
+        'requests': counters[REQUESTS],
+        'bytes_sent': counters[BYTES_SENT],
+        'status': status,
+        'cache': {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 4) if hits + misses else None,
+        },
+        'latency_ms': latency,
+    }
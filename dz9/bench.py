@@ -0,0 +1,170 @@
+import os
+import sys
+import glob
+import gzip
+import json
+import time
+import shlex
+import socket
+import shutil
+import resource
+import platform
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+from gendata import generate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LOADER = os.path.join(HERE, 'memc_load.py')
+FAKE_MEMCACHED = os.path.join(HERE, 'fakememc.py')
+START_TIMEOUT = 10
+DEV_TYPES = ('idfa', 'gaid', 'adid', 'dvid')
+
+
+def start_memcached(ports, latency, fail_rate, seed):
+    process = subprocess.Popen([
+        sys.executable, FAKE_MEMCACHED, '-p', ','.join(map(str, ports)),
+        '--latency', str(latency), '--fail-rate', str(fail_rate), '--seed', str(seed),
+    ])
+    deadline = time.monotonic() + START_TIMEOUT
+    for port in ports:
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    process.kill()
+                    raise RuntimeError('Fake memcached did not start on port {}'.format(port))
+                time.sleep(0.1)
+    return process
+
+
+def memcached_command(port, command):
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(command + b'\r\n')
+        data = b''
+        while not data.endswith((b'END\r\n', b'OK\r\n')):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return data
+
+
+def stored_items(ports):
+    items = 0
+    for port in ports:
+        for line in memcached_command(port, b'stats').split(b'\r\n'):
+            if line.startswith(b'STAT curr_items '):
+                items += int(line.split()[2])
+    return items
+
+
+def count_lines(paths):
+    lines = 0
+    for path in paths:
+        with gzip.open(path) as fd:
+            lines += sum(1 for _ in fd)
+    return lines
+
+
+def run_case(name, command, source, run_dir, ports, lines):
+    """Runs a loader over a fresh copy of the data, returns its report."""
+    shutil.rmtree(run_dir, ignore_errors=True)
+    shutil.copytree(source, run_dir)
+    for port in ports:
+        memcached_command(port, b'flush_all')
+    cpu_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    completed = subprocess.run(command, cwd=HERE)
+    duration = time.perf_counter() - started
+    cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    stored = stored_items(ports)
+    return {
+        'loader': name,
+        'command': ' '.join(command),
+        'exit_code': completed.returncode,
+        'duration': round(duration, 3),
+        'lines': lines,
+        'stored': stored,
+        'records_per_second': round(lines / duration, 1),
+        'stored_per_second': round(stored / duration, 1),
+        'cpu_seconds': round(cpu_after.ru_utime + cpu_after.ru_stime - cpu_before.ru_utime - cpu_before.ru_stime, 3),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=HERE, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-f", "--files", action="store", type=int, default=2)
+    parser.add_option("-n", "--lines", action="store", type=int, default=200000)
+    parser.add_option("--seed", action="store", type=int, default=42)
+    parser.add_option("--bad-rate", action="store", type=float, default=0.0)
+    parser.add_option("--member-size", action="store", type=int, default=None)
+    parser.add_option("-p", "--port", action="store", type=int, default=34013)
+    parser.add_option("--latency", action="store", type=float, default=0.0)
+    parser.add_option("--fail-rate", action="store", type=float, default=0.0)
+    parser.add_option("-w", "--workers", action="store", type=int, default=os.cpu_count())
+    parser.add_option("--loader-args", action="store", type=str, default='',
+                      help="extra options of memc_load.py, e.g. '--split=4 --noreply'")
+    parser.add_option("--go", action="store", type=str, default=None,
+                      help="command of the Go loader, e.g. '../dz12/memc_load_multi'")
+    parser.add_option("-o", "--output", action="store", type=str, default=None)
+
+    opts, args = parser.parse_args()
+    ports = [opts.port + index for index in range(len(DEV_TYPES))]
+    servers = ['--{}=127.0.0.1:{}'.format(dev_type, port) for dev_type, port in zip(DEV_TYPES, ports)]
+
+    with tempfile.TemporaryDirectory(prefix='memc-bench-') as tmp:
+        source = os.path.join(tmp, 'source')
+        paths = generate(source, opts.files, opts.lines, opts.seed, opts.bad_rate, opts.member_size)
+        lines = count_lines(paths)
+        run_dir = os.path.join(tmp, 'run')
+        pattern = os.path.join(run_dir, '*.tsv.gz')
+        memcached = start_memcached(ports, opts.latency, opts.fail_rate, opts.seed)
+        try:
+            cases = [('python', [sys.executable, LOADER, '--pattern=' + pattern, '-w', str(opts.workers),
+                                 '--stats-interval=0', '-l', os.path.join(tmp, 'memc_load.log')]
+                      + servers + shlex.split(opts.loader_args))]
+            if opts.go:
+                # the Go loader takes single dash flags
+                cases.append(('go', shlex.split(opts.go) + ['-pattern=' + pattern, '-workers=%s' % opts.workers]
+                              + [server[1:] for server in servers]))
+            results = [run_case(name, command, source, run_dir, ports, lines) for name, command in cases]
+        finally:
+            memcached.terminate()
+            memcached.wait()
+        compressed = sum(os.path.getsize(path) for path in glob.glob(os.path.join(source, '*.tsv.gz')))
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'config': {
+            'files': opts.files,
+            'lines_per_file': opts.lines,
+            'compressed_bytes': compressed,
+            'seed': opts.seed,
+            'bad_rate': opts.bad_rate,
+            'member_size': opts.member_size,
+            'latency': opts.latency,
+            'fail_rate': opts.fail_rate,
+            'workers': opts.workers,
+            'loader_args': opts.loader_args,
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if opts.output:
+        with open(opts.output, 'w') as fd:
+            fd.write(output + '\n')
+    print(output)
@@ -0,0 +1,114 @@
+import os
+import glob
+import json
+import time
+import logging
+import collections
+from threading import Lock
+
+SUFFIX = '.checkpoint'
+
+# put into every target queue after the batches of the lines before it, the
+# workers pass the token back to checkpointer.done()
+Marker = collections.namedtuple('Marker', ['checkpointer', 'token'])
+
+
+def checkpoint_path(fn, start):
+    return '%s.%s%s' % (fn, start, SUFFIX)
+
+
+def load_checkpoint(fn, start, end):
+    """Returns the saved progress of the range or None. A checkpoint of
+    another split of the file does not apply to this range."""
+    path = checkpoint_path(fn, start)
+    try:
+        with open(path) as fd:
+            state = json.load(fd)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.error("Cannot read checkpoint %s: %s" % (path, e))
+        return None
+    if state.get('start') != start or state.get('end') != end:
+        logging.info("Checkpoint %s is for the range [%s:%s], ignored" % (path, state.get('start'), state.get('end')))
+        return None
+    return state
+
+
+def remove_checkpoints(fn):
+    for path in glob.glob(glob.escape(fn) + '.*' + SUFFIX):
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.error("Cannot remove checkpoint %s: %s" % (path, e))
+
+
+def save_checkpoint(path, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fd:
+        json.dump(state, fd)
+        fd.flush()
+        os.fsync(fd.fileno())
+    # readers see either the previous or the new checkpoint
+    os.replace(tmp_path, path)
+
+
+class Checkpointer:
+    """Saves the progress of one range of a file next to it. A checkpoint at
+    a decompressed offset is written only when the workers of all targets
+    have passed its Marker, i.e. every line before it is stored."""
+
+    def __init__(self, fn, start, end, targets, processed=0, errors=0):
+        self.path = checkpoint_path(fn, start)
+        self.fn = fn
+        self.start = start
+        self.end = end
+        self.targets = targets
+        # progress of the previous runs of a resumed range
+        self.processed = processed
+        self.errors = errors
+        self.lock = Lock()
+        # every queue passes markers in order, so checkpoints complete in order;
+        # keyed by a sequence number, two markers may be at the same offset
+        self.pending = dict()
+        self.sequence = 0
+
+    def mark(self, offset, lines, errors, complete=False):
+        """Registers the producer side of a checkpoint, `errors` are the
+        lines it skipped so far. Returns the marker for the queues."""
+        with self.lock:
+            self.sequence += 1
+            self.pending[self.sequence] = {
+                'offset': offset,
+                'left': self.targets,
+                'lines': lines,
+                'processed': self.processed,
+                'errors': self.errors + errors,
+                'complete': complete,
+            }
+            return Marker(self, self.sequence)
+
+    def done(self, token, processed, errors):
+        """Called by a worker with its totals when it reaches the marker."""
+        with self.lock:
+            state = self.pending[token]
+            state['processed'] += processed
+            state['errors'] += errors
+            state['left'] -= 1
+            if state['left']:
+                return
+            del self.pending[token]
+            try:
+                save_checkpoint(self.path, {
+                    'file': self.fn,
+                    'start': self.start,
+                    'end': self.end,
+                    'offset': state['offset'],
+                    'lines': state['lines'],
+                    'processed': state['processed'],
+                    'errors': state['errors'],
+                    'complete': state['complete'],
+                    'time': time.time(),
+                })
+            except OSError as e:
+                logging.error("Cannot save checkpoint %s: %s" % (self.path, e))
@@ -0,0 +1,69 @@
+from array import array
+
+DEDUP_WINDOW = 100000
+DEDUP_MEMORY = 64 * 1024 * 1024
+# list slots, array and index entry of a record besides its ids and apps
+RECORD_OVERHEAD = 200
+
+
+class DedupWindow:
+    """Holds parsed records until `size` distinct keys or `memory` bytes are
+    collected and keeps only the latest record of every dev_type:dev_id.
+    The index maps hash((dev_type, dev_id)) to the position of the record,
+    the ids are compared on a hit, so a collision only costs a lost saving.
+    Records come out in the order of their latest line."""
+
+    def __init__(self, size=DEDUP_WINDOW, memory=DEDUP_MEMORY):
+        self.size = size
+        self.memory = memory
+        self.saved = 0
+        self._reset()
+
+    def _reset(self):
+        self.index = dict()
+        self.dev_types = list()
+        self.dev_ids = list()
+        self.lats = array('d')
+        self.lons = array('d')
+        self.apps = list()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, dev_types, dev_ids, lats, lons, apps):
+        """Adds the columns of a block, returns True when the window is full."""
+        index = self.index
+        for dev_type, dev_id, lat, lon, line_apps in zip(dev_types, dev_ids, lats, lons, apps):
+            key = hash((dev_type, dev_id))
+            position = index.get(key)
+            if position is not None and self.dev_ids[position] == dev_id and self.dev_types[position] == dev_type:
+                # the earlier record stays as a hole until the window is drained
+                self.dev_ids[position] = None
+                self.bytes -= _record_size(dev_id, self.apps[position])
+                self.apps[position] = None
+                self.saved += 1
+            index[key] = len(self.dev_ids)
+            self.dev_types.append(dev_type)
+            self.dev_ids.append(dev_id)
+            self.lats.append(lat)
+            self.lons.append(lon)
+            self.apps.append(line_apps)
+            self.bytes += _record_size(dev_id, line_apps)
+        return len(index) >= self.size or self.bytes >= self.memory
+
+    def drain(self):
+        """Returns the columns of the kept records and empties the window."""
+        dev_types, dev_ids, lats, lons, apps = self.dev_types, self.dev_ids, self.lats, self.lons, self.apps
+        self._reset()
+        live = [position for position, dev_id in enumerate(dev_ids) if dev_id is not None]
+        if len(live) == len(dev_ids):
+            return dev_types, dev_ids, lats, lons, apps
+        return ([dev_types[position] for position in live], [dev_ids[position] for position in live],
+                array('d', [lats[position] for position in live]), array('d', [lons[position] for position in live]),
+                [apps[position] for position in live])
+
+
+def _record_size(dev_id, apps):
+    return len(dev_id) + apps.itemsize * len(apps) + RECORD_OVERHEAD
+
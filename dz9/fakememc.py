@@ -0,0 +1,196 @@
+import random
+import signal
+import asyncio
+import logging
+from optparse import OptionParser
+
+PORTS = '33013,33014,33015,33016'
+LINE_END = b'\r\n'
+MAX_LINE = 2048
+
+
+class Storage:
+    """Items of one fake server. Values are kept as they are, flags and
+    expiration time are stored but not enforced."""
+
+    def __init__(self):
+        self.items = dict()
+        self.sets = 0
+        self.gets = 0
+        self.hits = 0
+        self.failed = 0
+
+
+class MemcacheProtocol(asyncio.Protocol):
+    """Text protocol subset used by the loaders: set (noreply), get and gets
+    with many keys, delete, version, stats, flush_all and quit.
+
+    Replies of the commands found in one received chunk are sent together
+    after `latency` seconds, so a pipelined batch pays it once like a real
+    round trip. `fail_rate` answers a set with SERVER_ERROR without storing,
+    like memcached even under noreply, `drop_rate` closes the connection
+    instead of answering a chunk."""
+
+    def __init__(self, storage, latency, fail_rate, drop_rate, rnd):
+        self.storage = storage
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.drop_rate = drop_rate
+        self.rnd = rnd
+        self.transport = None
+        self.buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        replies = bytearray()
+        while True:
+            end = self.buffer.find(LINE_END)
+            if end < 0:
+                # like memcached, long get lines of many keys are fine
+                if len(self.buffer) > MAX_LINE and not self.buffer.startswith((b'get ', b'gets ')):
+                    replies += b'CLIENT_ERROR line too long\r\n'
+                    self._send(replies, close=True)
+                    return
+                break
+            command = bytes(self.buffer[:end]).split()
+            if command and command[0] in (b'set', b'add', b'replace'):
+                consumed = self._store(command, end, replies)
+                if consumed is None:
+                    break
+                del self.buffer[:consumed]
+                continue
+            del self.buffer[:end + len(LINE_END)]
+            if command == [b'quit']:
+                self._send(replies, close=True)
+                return
+            self._command(command, replies)
+        if self.drop_rate and self.rnd.random() < self.drop_rate:
+            self.transport.abort()
+            return
+        self._send(replies)
+
+    def _store(self, command, end, replies):
+        """Returns the bytes taken from the buffer or None if the value has
+        not arrived yet."""
+        try:
+            key, flags, exptime, length = command[1], int(command[2]), int(command[3]), int(command[4])
+        except (IndexError, ValueError):
+            del self.buffer[:end + len(LINE_END)]
+            replies += b'CLIENT_ERROR bad command line format\r\n'
+            return 0
+        total = end + len(LINE_END) + length + len(LINE_END)
+        if len(self.buffer) < total:
+            return None
+        value = bytes(self.buffer[end + len(LINE_END):total - len(LINE_END)])
+        noreply = command[-1] == b'noreply'
+        storage = self.storage
+        if self.fail_rate and self.rnd.random() < self.fail_rate:
+            storage.failed += 1
+            reply = b'SERVER_ERROR out of memory storing object\r\n'
+        elif command[0] == b'add' and key in storage.items or command[0] == b'replace' and key not in storage.items:
+            reply = b'NOT_STORED\r\n'
+        else:
+            storage.items[key] = (flags, exptime, value)
+            storage.sets += 1
+            reply = b'STORED\r\n'
+        # memcached sends error replies under noreply too
+        if not noreply or reply.startswith(b'SERVER_ERROR'):
+            replies += reply
+        return total
+
+    def _command(self, command, replies):
+        storage = self.storage
+        name = command[0] if command else b''
+        if name in (b'get', b'gets'):
+            for key in command[1:]:
+                storage.gets += 1
+                item = storage.items.get(key)
+                if item is None:
+                    continue
+                storage.hits += 1
+                flags, _, value = item
+                if name == b'gets':
+                    replies += b'VALUE %s %d %d 0\r\n' % (key, flags, len(value))
+                else:
+                    replies += b'VALUE %s %d %d\r\n' % (key, flags, len(value))
+                replies += value + LINE_END
+            replies += b'END\r\n'
+        elif name == b'delete' and len(command) > 1:
+            found = storage.items.pop(command[1], None) is not None
+            if command[-1] != b'noreply':
+                replies += b'DELETED\r\n' if found else b'NOT_FOUND\r\n'
+        elif name == b'version':
+            replies += b'VERSION 1.6.0-fake\r\n'
+        elif name == b'stats':
+            for stat, value in (('curr_items', len(storage.items)), ('cmd_set', storage.sets),
+                                ('cmd_get', storage.gets), ('get_hits', storage.hits),
+                                ('injected_failures', storage.failed)):
+                replies += b'STAT %s %d\r\n' % (stat.encode(), value)
+            replies += b'END\r\n'
+        elif name == b'flush_all':
+            storage.items.clear()
+            if command[-1] != b'noreply':
+                replies += b'OK\r\n'
+        else:
+            replies += b'ERROR\r\n'
+
+    def _send(self, replies, close=False):
+        if not replies and not close:
+            return
+        if self.latency:
+            asyncio.get_running_loop().call_later(self.latency, self._write, bytes(replies), close)
+        else:
+            self._write(replies, close)
+
+    def _write(self, replies, close):
+        if self.transport.is_closing():
+            return
+        self.transport.write(replies)
+        if close:
+            self.transport.close()
+
+
+async def serve(host, ports, latency=0.0, fail_rate=0.0, drop_rate=0.0, seed=None):
+    """Starts one fake server with its own storage per port, returns the
+    asyncio servers."""
+    loop = asyncio.get_running_loop()
+    rnd = random.Random(seed)
+    servers = list()
+    for port in ports:
+        storage = Storage()
+        servers.append(await loop.create_server(
+            lambda storage=storage: MemcacheProtocol(storage, latency, fail_rate, drop_rate, rnd),
+            host, port, reuse_address=True))
+    return servers
+
+
+async def run(opts):
+    ports = [int(port) for port in opts.ports.split(',') if port.strip()]
+    servers = await serve(opts.host, ports, opts.latency, opts.fail_rate, opts.drop_rate, opts.seed)
+    logging.info('Fake memcached on %s:%s, latency %ss, fail rate %s, drop rate %s',
+                 opts.host, ','.join(map(str, ports)), opts.latency, opts.fail_rate, opts.drop_rate)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+    for server in servers:
+        server.close()
+        await server.wait_closed()
+
+
+if __name__ == '__main__':
+    op = OptionParser()
+    op.add_option('--host', action='store', default='127.0.0.1')
+    op.add_option('-p', '--ports', action='store', default=PORTS)
+    op.add_option('--latency', action='store', type=float, default=0.0)
+    op.add_option('--fail-rate', action='store', type=float, default=0.0)
+    op.add_option('--drop-rate', action='store', type=float, default=0.0)
+    op.add_option('--seed', action='store', type=int, default=None)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    asyncio.run(run(opts))
@@ -0,0 +1,80 @@
+import os
+import gzip
+import random
+import logging
+from optparse import OptionParser
+
+from gzinput import write_members
+
+DEV_TYPES = ('idfa', 'gaid', 'adid', 'dvid')
+# apps per device: most have a few dozen, some several hundred
+APPS_MEAN = 50
+APPS_MAX = 500
+APP_IDS = 10000
+
+
+def generate_lines(rnd, count, bad_rate=0.0):
+    """Lines in the format of the appsinstalled logs; with `bad_rate` some
+    lines get a broken field of the kinds parse_block skips or repairs."""
+    app_ids = [str(app) for app in range(APP_IDS)]
+    for _ in range(count):
+        dev_type = rnd.choice(DEV_TYPES)
+        dev_id = '%032x' % rnd.getrandbits(128) if rnd.random() < 0.5 else '%016x' % rnd.getrandbits(64)
+        lat = '%.9f' % rnd.uniform(-90, 90)
+        lon = '%.9f' % rnd.uniform(-180, 180)
+        apps_count = min(int(rnd.expovariate(1 / APPS_MEAN)) + 1, APPS_MAX)
+        apps = ','.join(rnd.choices(app_ids, k=apps_count))
+        if bad_rate and rnd.random() < bad_rate:
+            kind = rnd.randrange(4)
+            if kind == 0:
+                dev_id = ''
+            elif kind == 1:
+                lat = 'north'
+            elif kind == 2:
+                apps += ',x1'
+            else:
+                apps = apps + '\t' + apps
+        yield '\t'.join((dev_type, dev_id, lat, lon, apps)) + '\n'
+
+
+def generate_file(path, lines, seed, bad_rate=0.0, member_size=None, level=6):
+    """Writes a .tsv.gz with the same content for the same seed. With
+    `member_size` the file is recompressed into members for --split."""
+    rnd = random.Random(seed)
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wt', compresslevel=level) as fd:
+        chunk = list()
+        for line in generate_lines(rnd, lines, bad_rate):
+            chunk.append(line)
+            if len(chunk) >= 10000:
+                fd.write(''.join(chunk))
+                chunk = list()
+        fd.write(''.join(chunk))
+    if member_size:
+        write_members(tmp_path, member_size, level)
+    os.replace(tmp_path, path)
+    return path
+
+
+def generate(directory, files, lines, seed, bad_rate=0.0, member_size=None):
+    os.makedirs(directory, exist_ok=True)
+    paths = list()
+    for index in range(files):
+        path = os.path.join(directory, '2017092900%02d00.tsv.gz' % index)
+        paths.append(generate_file(path, lines, seed + index, bad_rate, member_size))
+    return paths
+
+
+if __name__ == '__main__':
+    op = OptionParser()
+    op.add_option('-o', '--output', action='store', default='data/synthetic')
+    op.add_option('-f', '--files', action='store', type=int, default=4)
+    op.add_option('-n', '--lines', action='store', type=int, default=1000000)
+    op.add_option('--seed', action='store', type=int, default=42)
+    op.add_option('--bad-rate', action='store', type=float, default=0.0)
+    op.add_option('--member-size', action='store', type=int, default=None)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    for file_name in generate(opts.output, opts.files, opts.lines, opts.seed, opts.bad_rate, opts.member_size):
+        logging.info('%s: %s lines, %s bytes', file_name, opts.lines, os.path.getsize(file_name))
@@ -0,0 +1,326 @@
+import os
+import zlib
+import queue
+import shutil
+import struct
+import logging
+import threading
+import subprocess
+from optparse import OptionParser
+
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+READ_SIZE = 1024 * 1024
+BLOCK_SIZE = 4 * 1024 * 1024
+# decompressed blocks waiting for the parser
+QUEUE_BLOCKS = 4
+PUT_TIMEOUT = 0.5
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+METHODS = ('auto', 'zlib', 'isal', 'pigz')
+
+MEMBER_MAGIC = b'\x1f\x8b\x08'
+FEXTRA = 0x04
+RESERVED_FLAGS = 0xe0
+# decompressed bytes of whole lines per member written by write_members
+MEMBER_SIZE = 16 * 1024 * 1024
+COMPRESS_LEVEL = 6
+SCAN_SIZE = 1024 * 1024
+# compressed bytes a candidate member must inflate without errors
+VALIDATE_SIZE = 64 * 1024
+HEADER_SIZE = 64
+# extra subfield with the size of the whole member: BGZF (bgzip) or ours
+BGZF_FIELD = b'BC'
+MEMBER_FIELD = b'ML'
+_MEMBER_HEADER = struct.Struct('<3sBIBBH2sHQ')
+
+
+def resolve_method(method):
+    """'auto' prefers isal (the same gzip stream, inflated several times
+    faster) and falls back to zlib. pigz is used only when asked for."""
+    if method == 'auto':
+        return 'isal' if isal_zlib is not None else 'zlib'
+    if method == 'isal' and isal_zlib is None:
+        raise ValueError('isal is not installed')
+    if method == 'pigz' and shutil.which('pigz') is None:
+        raise ValueError('pigz is not found in PATH')
+    if method not in METHODS:
+        raise ValueError('Unknown gzip method: %s' % method)
+    return method
+
+
+def iter_blocks(path, block_size=BLOCK_SIZE, method='auto', start=0, end=None):
+    """Yields blocks of whole lines of about `block_size` decompressed bytes.
+
+    A reader thread inflates the file while the caller parses the previous
+    blocks: zlib and isal release the GIL for the whole call, pigz runs as a
+    separate process. At most QUEUE_BLOCKS blocks are kept ahead.
+
+    `start` and `end` limit the reading to the members of a range from
+    split_ranges. Like Hadoop input splits, a range skips its first line
+    unless it starts the file, and finishes its last line in the next range."""
+    method = resolve_method(method)
+    if method == 'pigz' and (start or end is not None):
+        # pigz can not start in the middle of a file
+        method = resolve_method('auto')
+    blocks = queue.Queue(QUEUE_BLOCKS)
+    stop = threading.Event()
+    thread = threading.Thread(target=_read, args=(path, method, block_size, blocks, stop, start, end),
+                              name='gunzip', daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _read(path, method, block_size, blocks, stop, start, end):
+    pending = bytearray()
+    skip_head = start > 0
+    chunks = None
+    try:
+        if method == 'pigz':
+            chunks = _pigz(path)
+        else:
+            chunks = _inflate(path, isal_zlib if method == 'isal' else zlib, start, end)
+        for data, past_end in chunks:
+            if past_end:
+                # no line starts in the range or the last one is complete
+                if skip_head:
+                    break
+                newline = data.find(b'\n')
+                if newline >= 0:
+                    pending += data[:newline + 1]
+                    break
+            elif skip_head:
+                newline = data.find(b'\n')
+                if newline < 0:
+                    continue
+                data = data[newline + 1:]
+                skip_head = False
+            pending += data
+            if len(pending) < block_size:
+                continue
+            cut = pending.rfind(b'\n') + 1
+            if not cut:
+                continue
+            with memoryview(pending) as view:
+                block = bytes(view[:cut])
+            del pending[:cut]
+            if not _put(blocks, block, stop):
+                return
+        if pending:
+            _put(blocks, bytes(pending), stop)
+    except Exception as e:
+        logging.error('Cannot read %s: %s', path, e)
+        _put(blocks, e, stop)
+    finally:
+        if chunks is not None:
+            chunks.close()
+    _put(blocks, None, stop)
+
+
+def _put(blocks, item, stop):
+    """Waits for room in the queue until the consumer goes away."""
+    while not stop.is_set():
+        try:
+            blocks.put(item, timeout=PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _inflate(path, module, start=0, end=None):
+    """Decompresses gzip members one after another from `start`, yields
+    (data, past_end) where past_end marks the members from `end` on."""
+    with open(path, 'rb') as fd:
+        fd.seek(start)
+        offset = start
+        past_end = False
+        decompressor = module.decompressobj(GZIP_WBITS)
+        fed = False
+        while True:
+            raw = fd.read(READ_SIZE)
+            if not raw:
+                break
+            offset += len(raw)
+            while raw:
+                fed = True
+                data = decompressor.decompress(raw)
+                if data:
+                    yield data, past_end
+                if not decompressor.eof:
+                    break
+                # the end of a member, the next one may follow
+                raw = decompressor.unused_data
+                decompressor = module.decompressobj(GZIP_WBITS)
+                fed = False
+                member = offset - len(raw)
+                if end is not None and not past_end and member >= end:
+                    if member != end:
+                        raise ValueError('No gzip member starts at %s' % end)
+                    past_end = True
+        if fed and not decompressor.eof:
+            raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+
+def _pigz(path):
+    """Yields the output of pigz in the (data, past_end) form of _inflate."""
+    process = subprocess.Popen(['pigz', '-dc', path], stdout=subprocess.PIPE)
+    try:
+        while True:
+            data = process.stdout.read(READ_SIZE)
+            if not data:
+                break
+            yield data, False
+        if process.wait():
+            raise OSError('pigz exited with code %s' % process.returncode)
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+
+
+def split_ranges(path, parts):
+    """Cuts the file at member starts into at most `parts` ranges (start, end)
+    of similar compressed size, the last one ends with the file (None)."""
+    offsets = member_offsets(path)
+    if parts < 2 or len(offsets) < 2:
+        return [(0, None)]
+    step = os.path.getsize(path) / parts
+    ranges = list()
+    start = 0
+    for offset in offsets[1:]:
+        if offset - start >= step and len(ranges) < parts - 1:
+            ranges.append((start, offset))
+            start = offset
+    ranges.append((start, None))
+    return ranges
+
+
+def member_offsets(path):
+    """Offsets of the gzip members of the file. Members with their size in
+    the header (BGZF, write_members) are followed by seeking, otherwise the
+    file is scanned for member headers that inflate."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as fd:
+        fileno = fd.fileno()
+        offsets = list()
+        offset = 0
+        while offset < size:
+            member_size = _member_size(os.pread(fileno, HEADER_SIZE, offset))
+            if member_size is None:
+                break
+            offsets.append(offset)
+            offset += member_size
+        else:
+            return offsets or [0]
+        return _scan_members(fd)
+
+
+def _member_size(head):
+    if len(head) < 12 or head[:3] != MEMBER_MAGIC or not head[3] & FEXTRA:
+        return None
+    extra_end = 12 + int.from_bytes(head[10:12], 'little')
+    position = 12
+    while position + 4 <= min(extra_end, len(head)):
+        field = head[position:position + 2]
+        length = int.from_bytes(head[position + 2:position + 4], 'little')
+        value = head[position + 4:position + 4 + length]
+        if field == BGZF_FIELD and length == 2 and len(value) == 2:
+            return int.from_bytes(value, 'little') + 1
+        if field == MEMBER_FIELD and length == 8 and len(value) == 8:
+            return int.from_bytes(value, 'little')
+        position += 4 + length
+    return None
+
+
+def _scan_members(fd):
+    fileno = fd.fileno()
+    offsets = [0]
+    position = 0
+    tail = b''
+    fd.seek(0)
+    while True:
+        chunk = fd.read(SCAN_SIZE)
+        if not chunk:
+            break
+        data = tail + chunk
+        base = position - len(tail)
+        index = data.find(MEMBER_MAGIC, 1 if base == 0 else 0)
+        while index >= 0:
+            if _is_member(fileno, base + index):
+                offsets.append(base + index)
+            index = data.find(MEMBER_MAGIC, index + 1)
+        tail = data[1 - len(MEMBER_MAGIC):]
+        position += len(chunk)
+    return offsets
+
+
+def _is_member(fileno, offset):
+    """The magic bytes may occur inside compressed data, a real member
+    header is followed by a stream that inflates. A wrong guess is caught
+    by _inflate, the range before it does not end at a member end."""
+    head = os.pread(fileno, VALIDATE_SIZE, offset)
+    if len(head) < 18 or head[3] & RESERVED_FLAGS:
+        return False
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    try:
+        data = decompressor.decompress(head)
+    except zlib.error:
+        return False
+    return bool(data) or decompressor.eof
+
+
+def write_members(path, member_size=MEMBER_SIZE, level=COMPRESS_LEVEL):
+    """Recompresses the file into members of whole lines that carry their
+    own size, so split_ranges indexes it without a scan. The file is
+    replaced only when it is written completely."""
+    tmp_path = path + '.tmp'
+    count = 0
+    with open(tmp_path, 'wb') as fd:
+        for block in iter_blocks(path, member_size):
+            # a single inflated chunk may be many times bigger than a member
+            start = 0
+            while start < len(block):
+                cut = block.rfind(b'\n', start, start + member_size) + 1
+                if cut <= start:
+                    cut = block.find(b'\n', start + member_size) + 1 or len(block)
+                fd.write(_member(block[start:cut], level))
+                count += 1
+                start = cut
+    os.replace(tmp_path, path)
+    return count
+
+
+def _member(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    trailer = struct.pack('<II', zlib.crc32(data), len(data) & 0xffffffff)
+    size = _MEMBER_HEADER.size + len(body) + len(trailer)
+    # mtime 0, xfl 0, os 255 (unknown), one extra subfield of 8 bytes
+    header = _MEMBER_HEADER.pack(MEMBER_MAGIC, FEXTRA, 0, 0, 255, 12, MEMBER_FIELD, 8, size)
+    return header + body + trailer
+
+
+if __name__ == '__main__':
+    op = OptionParser(usage='%prog [options] FILE...')
+    op.add_option('-s', '--member-size', action='store', type=int, default=MEMBER_SIZE)
+    op.add_option('--level', action='store', type=int, default=COMPRESS_LEVEL)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    for file_name in args:
+        members = write_members(file_name, opts.member_size, opts.level)
+        logging.info('%s: %s members', file_name, members)
@@ -0,0 +1,318 @@
+import re
+import bisect
+import asyncio
+import hashlib
+import logging
+
+SOCKET_TIMEOUT = 2
+CONNECTIONS = 4
+# ring points per server as in libketama: 40 md5 digests of 4 points each
+KETAMA_DIGESTS = 40
+# keys of one get command of get_many
+GET_KEYS = 100
+STORED = b'STORED\r\n'
+NOT_STORED = b'NOT_STORED\r\n'
+SERVER_ERROR = b'SERVER_ERROR'
+CLIENT_ERROR = b'CLIENT_ERROR'
+VERSION = b'VERSION'
+END = b'END\r\n'
+# limit of memcached, keys must not have whitespace or control characters
+MAX_KEY_LENGTH = 250
+_BAD_KEY_CHARS = re.compile(rb'[\x00-\x20\x7f]')
+
+
+class MemcacheError(Exception):
+    pass
+
+
+class Connection:
+    """One memcached connection speaking the text protocol. Commands of a
+    batch are written in a single buffer and their replies read afterwards,
+    so a batch costs one round trip instead of one per key."""
+
+    def __init__(self, address, timeout=SOCKET_TIMEOUT):
+        host, _, port = address.rpartition(':')
+        self.host = host or '127.0.0.1'
+        self.port = int(port)
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.bytes_sent = 0
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def set_many(self, items, noreply=False):
+        """Stores [(key, value)] pairs, returns the keys the server did not store.
+
+        With noreply the server sends nothing back for stored keys, a trailing
+        `version` command confirms that the whole batch was read. Failed sets
+        are still answered with SERVER_ERROR or CLIENT_ERROR lines, which do
+        not name their keys; the batch is then stored again with replies, and
+        the keys failed in that round are returned. Values are plain
+        overwrites, so storing a key twice can not corrupt anything."""
+        rejected = [key for key, _ in items if not valid_key(key)]
+        if rejected:
+            # a bad key would break the text protocol for the whole connection
+            items = [item for item in items if valid_key(item[0])]
+            if not items:
+                return rejected
+        if self.writer is None:
+            await self.open()
+        await self._write_sets(items, noreply)
+        if noreply:
+            errors = await asyncio.wait_for(self._read_version(), self.timeout)
+            if not errors:
+                return rejected
+            await self._write_sets(items, False)
+        return rejected + await asyncio.wait_for(self._read_stored(items), self.timeout)
+
+    async def _write_sets(self, items, noreply):
+        suffix = b' noreply\r\n' if noreply else b'\r\n'
+        buffer = bytearray()
+        for key, value in items:
+            buffer += b'set %s 0 0 %d%s' % (_key(key), len(value), suffix)
+            buffer += value
+            buffer += b'\r\n'
+        if noreply:
+            buffer += b'version\r\n'
+        self.writer.write(buffer)
+        self.bytes_sent += len(buffer)
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    async def get_many(self, keys):
+        """Returns {key: value} of the keys found. The keys go in get commands
+        of GET_KEYS keys written in one buffer, like the sets of set_many."""
+        if self.writer is None:
+            await self.open()
+        keys = [_key(key) for key in keys if valid_key(key)]
+        if not keys:
+            return {}
+        buffer = bytearray()
+        commands = 0
+        for start in range(0, len(keys), GET_KEYS):
+            buffer += b'get %s\r\n' % b' '.join(keys[start:start + GET_KEYS])
+            commands += 1
+        self.writer.write(buffer)
+        self.bytes_sent += len(buffer)
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+        return await asyncio.wait_for(self._read_values(commands), self.timeout)
+
+    async def _read_values(self, commands):
+        values = dict()
+        while commands:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError('Connection closed by {}:{}'.format(self.host, self.port))
+            if line == END:
+                commands -= 1
+                continue
+            parts = line.split()
+            if len(parts) < 4 or parts[0] != b'VALUE':
+                raise MemcacheError('Unexpected reply: {!r}'.format(line))
+            data = await self.reader.readexactly(int(parts[3]) + 2)
+            values[parts[1]] = data[:-2]
+        return values
+
+    async def _read_stored(self, items):
+        """Reads the reply of every set, returns the keys not stored."""
+        failed = list()
+        for key, _ in items:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError('Connection closed by {}:{}'.format(self.host, self.port))
+            if line != STORED:
+                if line != NOT_STORED and not line.startswith((SERVER_ERROR, CLIENT_ERROR)):
+                    # the replies of the next keys can not be matched any more,
+                    # the pool closes the connection
+                    raise MemcacheError('Unexpected reply: {!r}'.format(line))
+                failed.append(key)
+        return failed
+
+    async def _read_version(self):
+        """Reads the replies of a noreply batch up to the VERSION line,
+        returns the number of error lines of failed sets before it."""
+        errors = 0
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError('Connection closed by {}:{}'.format(self.host, self.port))
+            if line.startswith(VERSION):
+                return errors
+            if not line.startswith((SERVER_ERROR, CLIENT_ERROR)):
+                raise MemcacheError('Unexpected reply: {!r}'.format(line))
+            errors += 1
+
+
+class MemcachePool:
+    """Several pipelined connections to one memcached server. A batch is
+    split between the connections and the parts are sent concurrently."""
+
+    def __init__(self, address, connections=CONNECTIONS, timeout=SOCKET_TIMEOUT):
+        self.address = address
+        self.connections = [Connection(address, timeout) for _ in range(connections)]
+        # parts failed by timeouts and broken connections, not by the server
+        self.broken = 0
+
+    def __repr__(self):
+        return 'MemcachePool({})'.format(self.address)
+
+    @property
+    def bytes_sent(self):
+        return sum(connection.bytes_sent for connection in self.connections)
+
+    async def set_many(self, items, noreply=False):
+        """Returns the keys that were not stored, a broken connection fails its
+        whole part and is reopened on the next batch. A key always goes to the
+        same connection, so a later set of it is not overtaken by an earlier."""
+        count = len(self.connections)
+        if count == 1:
+            parts = [items]
+        else:
+            parts = [list() for _ in range(count)]
+            for item in items:
+                parts[hash(item[0]) % count].append(item)
+        results = await asyncio.gather(*(
+            self._set_part(connection, part, noreply)
+            for connection, part in zip(self.connections, parts) if part
+        ))
+        return [key for failed in results for key in failed]
+
+    async def _set_part(self, connection, items, noreply):
+        try:
+            return await connection.set_many(items, noreply)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, MemcacheError) as e:
+            logging.error('Cannot write to memc %s: %r', self.address, e)
+            self.broken += 1
+            connection.close()
+            return [key for key, _ in items]
+
+    async def get_many(self, keys):
+        """Returns {key: value} of the keys found, the keys of a broken
+        connection are not found."""
+        count = len(self.connections)
+        parts = [list() for _ in range(count)]
+        for key in keys:
+            parts[hash(key) % count].append(key)
+        results = await asyncio.gather(*(
+            self._get_part(connection, part)
+            for connection, part in zip(self.connections, parts) if part
+        ))
+        values = dict()
+        for part in results:
+            values.update(part)
+        return values
+
+    async def _get_part(self, connection, keys):
+        try:
+            return await connection.get_many(keys)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, MemcacheError) as e:
+            logging.error('Cannot read from memc %s: %r', self.address, e)
+            self.broken += 1
+            connection.close()
+            return {}
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+
+
+def _key(key):
+    return key if isinstance(key, bytes) else key.encode()
+
+
+def valid_key(key):
+    key = _key(key)
+    return 0 < len(key) <= MAX_KEY_LENGTH and not _BAD_KEY_CHARS.search(key)
+
+
+class HashRing:
+    """Ketama consistent hashing: a server owns the ring points hashed from
+    "host:port-N", a key goes to the server of the next point after the
+    hash of the key. Adding a server moves only the keys of its points."""
+
+    def __init__(self, servers):
+        points = list()
+        for server in servers:
+            for index in range(KETAMA_DIGESTS):
+                digest = hashlib.md5(('%s-%s' % (server, index)).encode()).digest()
+                for part in range(4):
+                    points.append((int.from_bytes(digest[part * 4:part * 4 + 4], 'little'), server))
+        points.sort()
+        self.points = [point for point, _ in points]
+        self.servers = [server for _, server in points]
+
+    def get(self, key):
+        point = int.from_bytes(hashlib.md5(_key(key)).digest()[:4], 'little')
+        index = bisect.bisect(self.points, point)
+        return self.servers[index if index < len(self.points) else 0]
+
+
+class ShardedPool:
+    """MemcachePool per server of a device type, keys are spread by HashRing.
+    A batch is split per server and the parts are written concurrently."""
+
+    def __init__(self, addresses, connections=CONNECTIONS, timeout=SOCKET_TIMEOUT):
+        self.addresses = addresses
+        self.pools = {address: MemcachePool(address, connections, timeout) for address in addresses}
+        self.ring = HashRing(addresses) if len(addresses) > 1 else None
+        # keys sent and not stored per server, retries included
+        self.sent = dict.fromkeys(addresses, 0)
+        self.failed = dict.fromkeys(addresses, 0)
+
+    def __repr__(self):
+        return 'ShardedPool({})'.format(','.join(self.addresses))
+
+    @property
+    def bytes_sent(self):
+        return sum(pool.bytes_sent for pool in self.pools.values())
+
+    @property
+    def broken(self):
+        return sum(pool.broken for pool in self.pools.values())
+
+    async def set_many(self, items, noreply=False):
+        if self.ring is None:
+            parts = {self.addresses[0]: items}
+        else:
+            parts = {address: list() for address in self.addresses}
+            get = self.ring.get
+            for item in items:
+                parts[get(item[0])].append(item)
+        parts = [(address, part) for address, part in parts.items() if part]
+        results = await asyncio.gather(*(self.pools[address].set_many(part, noreply) for address, part in parts))
+        for (address, part), failed in zip(parts, results):
+            self.sent[address] += len(part)
+            self.failed[address] += len(failed)
+        return [key for failed in results for key in failed]
+
+    async def get_many(self, keys):
+        if self.ring is None:
+            parts = {self.addresses[0]: keys}
+        else:
+            parts = {address: list() for address in self.addresses}
+            get = self.ring.get
+            for key in keys:
+                parts[get(key)].append(key)
+        results = await asyncio.gather(*(self.pools[address].get_many(part) for address, part in parts.items() if part))
+        values = dict()
+        for part in results:
+            values.update(part)
+        return values
+
+    def report(self):
+        return {
+            address: {'sent': self.sent[address], 'failed': self.failed[address],
+                      'bytes_sent': self.pools[address].bytes_sent}
+            for address in self.addresses
+        }
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
@@ -1,27 +1,51 @@
 import os
-import gzip
 import sys
 import glob
+import json
+import time
+import heapq
+import bisect
+import asyncio
 import logging
 import collections
-from multiprocessing import Pool, cpu_count
+from array import array
+from multiprocessing import Pool, Process, Queue as ProcessQueue, cpu_count
 from optparse import OptionParser
 from queue import Queue, Empty
 from threading import Thread
-from time import sleep
 
 import appsinstalled_pb2
-import memcache
+from memc_async import HashRing, ShardedPool, CONNECTIONS, valid_key
+from userapps import UserAppsEncoder
+from dedup import DedupWindow, DEDUP_MEMORY
+from shmring import RingBuffer, RING_SIZE, pack_items, unpack_items
+from gzinput import iter_blocks, split_ranges, METHODS
+from checkpoint import Checkpointer, Marker, load_checkpoint, remove_checkpoints
+from telemetry import RangeStats, TargetStats, STATS_INTERVAL, summary
 
 NORMAL_ERR_RATE = 0.01
-AppsInstalled = collections.namedtuple("AppsInstalled", ["dev_type", "dev_id", "lat", "lon", "apps"])
-FINISH = 'finish'
+ParsedBlock = collections.namedtuple("ParsedBlock", ["dev_types", "dev_ids", "lats", "lons", "apps", "bad", "partial"])
+# items whose stored and failed keys are counted in stats other than those of the worker
+Batch = collections.namedtuple("Batch", ["items", "stats"])
+FINISH = None
 SOCKET_TIMEOUT = 2
-DEAD_RETRY = 20
+# sends of a key after the first one, a failed key waits RETRY_DELAY * 2**attempt
 RETRIES = 3
-RETRIES_SLEEP = 1
-GET_TIMEOUT = 0.1
-CHUNK_SIZE = 10
+RETRY_DELAY = 0.1
+CHUNK_SIZE = 1000
+# bounds of the write batches of a worker and the latency it keeps them under
+BATCH_MIN = 100
+BATCH_MAX = 20000
+TARGET_LATENCY = 0.05
+# batches waiting for every memcached, the producer blocks when they are full
+QUEUE_BATCHES = 4
+CHECKPOINT_INTERVAL = 60
+# frames of the shared memory rings: records of a range, end of a range, end of the run
+ITEMS_FRAME = 1
+END_FRAME = 2
+STOP_FRAME = 3
+# seconds between checks that the parser and writer processes are alive
+PROCESS_CHECK = 1
 
 
 def dot_rename(path):
@@ -30,176 +54,600 @@ def dot_rename(path):
     os.rename(path, os.path.join(head, "." + fn))
 
 
-def insert_appsinstalled(memc, chunks: dict, dry_run=False):
-    processed = errors = 0
+async def insert_appsinstalled(memc, batch: list, dry_run=False, noreply=False):
+    """Returns the keys of the batch that were not stored."""
     try:
         if dry_run:
-            for key, value in chunks.items():
+            for key, value in batch:
                 logging.debug('%s - %s -> %s' % (memc, key, value))
-                processed += 1
-        else:
-            processed, errors = memcache_set(memc, chunks)
+            return []
+        return await memc.set_many(batch, noreply)
     except Exception as e:
         logging.exception("Cannot write to memc %s: %s" % (memc, e))
-    return processed, errors
-
-
-def memcache_set(memc, chunks):
-    notset_keys = memc.set_multi(chunks)
-    retries = 0
-    while notset_keys and retries < RETRIES:
-        notset_keys = memc.set_multi({
-            key: chunks[key]
-            for key in notset_keys
-        })
-        retries += 1
-        sleep(RETRIES_SLEEP)
-    errors = len(notset_keys)
-    return len(chunks.keys()) - errors, errors
-
-
-def prepare_appsinstalled(appsinstalled):
-    ua = appsinstalled_pb2.UserApps()
-    ua.lat = appsinstalled.lat
-    ua.lon = appsinstalled.lon
-    key = '%s:%s' % (appsinstalled.dev_type, appsinstalled.dev_id)
-    ua.apps.extend(appsinstalled.apps)
-    packed = ua.SerializeToString()
-    return (key, packed)
-
-
-def parse_appsinstalled(line):
-    line = str(line)
-    line_parts = line.strip().split("\t")
-    if len(line_parts) < 5:
-        return
-    dev_type, dev_id, lat, lon, raw_apps = line_parts
-    if not dev_type or not dev_id:
-        return
-    try:
-        apps = [int(a.strip()) for a in raw_apps.split(",")]
-    except ValueError:
-        apps = [int(a.strip()) for a in raw_apps.split(",") if a.isidigit()]
-        logging.info("Not all user apps are digits: `%s`" % line)
-    try:
-        lat, lon = float(lat), float(lon)
-    except ValueError:
-        logging.info("Invalid geo coords: `%s`" % line)
-    return AppsInstalled(dev_type, dev_id, lat, lon, apps)
+        return [key for key, _ in batch]
+
+
+class BatchSizer:
+    """Size of the next write batch: grows by BATCH_MIN while batches are
+    written under the target latency, halves on a timeout or a broken
+    connection and when a batch takes twice the target."""
+
+    def __init__(self, size, target_latency=TARGET_LATENCY, minimum=BATCH_MIN, maximum=BATCH_MAX):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.size = min(max(size, self.minimum), self.maximum)
+        self.target_latency = target_latency
+
+    def update(self, latency, broken=False):
+        if broken or latency > self.target_latency * 2:
+            self.size = max(self.size // 2, self.minimum)
+        elif latency < self.target_latency:
+            self.size = min(self.size + self.minimum, self.maximum)
+        return self.size
+
+
+def parse_block(block):
+    """Splits a block of tab separated lines into columns. Apps of a line go
+    into one array('I') converted by int() in C, without a list per line.
+    Skipped lines are counted by reason in `bad`, `partial` counts the lines
+    that lost some not numeric apps."""
+    dev_types = list()
+    dev_ids = list()
+    lats = array('d')
+    lons = array('d')
+    apps = list()
+    bad = collections.Counter()
+    partial = 0
+    for line in block.split(b'\n'):
+        line_parts = line.strip().split(b'\t')
+        if len(line_parts) != 5:
+            if line_parts != [b'']:
+                bad['fields'] += 1
+            continue
+        dev_type, dev_id, lat, lon, raw_apps = line_parts
+        if not dev_type or not dev_id:
+            bad['no_id'] += 1
+            continue
+        try:
+            lat, lon = float(lat), float(lon)
+        except ValueError:
+            bad['geo'] += 1
+            continue
+        try:
+            line_apps = array('I', map(int, raw_apps.split(b',')))
+        except (ValueError, OverflowError):
+            line_apps = array('I', [int(a) for a in raw_apps.split(b',') if _is_app(a)])
+            partial += 1
+        dev_types.append(dev_type)
+        dev_ids.append(dev_id)
+        lats.append(lat)
+        lons.append(lon)
+        apps.append(line_apps)
+    return ParsedBlock(dev_types, dev_ids, lats, lons, apps, bad, partial)
+
+
+def _is_app(raw_app):
+    raw_app = raw_app.strip()
+    return raw_app.isdigit() and int(raw_app) <= 0xffffffff
 
 
 class Worker(Thread):
-    def __init__(self, job_pool, memc, results_queue, dry_run=False):
+    """Writes the items of the batches from the producer in batches of its
+    own size. Failed keys go back into the next batches after a delay until
+    they run out of RETRIES, a marker or the end waits for all of them.
+
+    Stored, failed and retried keys are counted in `stats` or in the stats
+    that come with a Batch, the batches written and bytes sent in `stats`."""
+
+    def __init__(self, job_pool, memc, stats, dry_run=False, noreply=False, batch_size=CHUNK_SIZE,
+                 target_latency=TARGET_LATENCY):
         super().__init__()
         self.job_pool = job_pool
-        self.results_queue = results_queue
         self.memc = memc
+        self.stats = stats
         self.dry_run = dry_run
+        self.noreply = noreply
+        self.sizer = BatchSizer(batch_size, target_latency)
+        self.pending = collections.deque()
+        # [count, stats] of the runs of pending items
+        self.owners = collections.deque()
+        # (ready time, sequence, attempt, key, value, stats) of the keys to send again
+        self.retries = list()
+        self.sequence = 0
+        # sequence of the latest retry per key, a newer value of the key cancels it
+        self.waiting = dict()
 
     def run(self) -> None:
         logging.info('[Worker %s] Start thread: %s' % (os.getpid(), self.name))
-        processed = 0
-        errors = 0
-        chunk = dict()
+        # every worker drives the pipelined connections of its memcached in its own loop
+        loop = asyncio.new_event_loop()
         while True:
-            try:
-                try:
-                    line = self.job_pool.get(timeout=GET_TIMEOUT)
-                except Empty:
+            batch = self.job_pool.get()
+            if batch is FINISH:
+                self.flush(loop)
+                break
+            if isinstance(batch, Marker):
+                self.flush(loop)
+                batch.checkpointer.done(batch.token, self.stats.processed, self.stats.errors)
+                continue
+            if isinstance(batch, Batch):
+                self.add(batch.items, batch.stats)
+            else:
+                self.add(batch, self.stats)
+            while len(self.pending) >= self.sizer.size:
+                self.insert(loop)
+        self.memc.close()
+        loop.close()
+        logging.info('[Worker %s] Stop thread: %s' % (os.getpid(), self.name))
+
+    def add(self, items, stats):
+        if not items:
+            return
+        self.pending.extend(items)
+        if self.owners and self.owners[-1][1] is stats:
+            self.owners[-1][0] += len(items)
+        else:
+            self.owners.append([len(items), stats])
+
+    def flush(self, loop):
+        while self.pending or self.retries:
+            if not self.pending:
+                # only the failed keys are left, wait for the first of them
+                time.sleep(max(self.retries[0][0] - time.monotonic(), 0))
+            self.insert(loop)
+
+    def insert(self, loop):
+        """Writes the keys due to be sent again, then new items up to the size."""
+        size = self.sizer.size
+        now = time.monotonic()
+        batch = list()
+        # (end of the items in the batch, stats) of the runs of the batch
+        owners = list()
+        attempts = dict()
+        waiting = self.waiting
+        while self.retries and self.retries[0][0] <= now and len(batch) < size:
+            _, sequence, attempt, key, value, stats = heapq.heappop(self.retries)
+            if waiting.get(key) != sequence:
+                # the newer value is sent already, it would be overwritten
+                stats.processed += 1
+                continue
+            del waiting[key]
+            batch.append((key, value))
+            attempts[key] = attempt
+            _add_owner(owners, len(batch), stats)
+        while self.pending and len(batch) < size:
+            run = self.owners[0]
+            take = min(run[0], size - len(batch))
+            for _ in range(take):
+                item = self.pending.popleft()
+                if waiting:
+                    waiting.pop(item[0], None)
+                batch.append(item)
+            run[0] -= take
+            if not run[0]:
+                self.owners.popleft()
+            _add_owner(owners, len(batch), run[1])
+        if not batch:
+            return
+        broken = self.memc.broken
+        started = time.monotonic()
+        failed = loop.run_until_complete(insert_appsinstalled(self.memc, batch, self.dry_run, self.noreply))
+        latency = time.monotonic() - started
+        self.sizer.update(latency, self.memc.broken > broken)
+        lost = [0] * len(owners)
+        if failed:
+            ends = [end for end, _ in owners]
+            positions = {item[0]: index for index, item in enumerate(batch)}
+            now = time.monotonic()
+            for key in failed:
+                position = positions[key]
+                owner = bisect.bisect_right(ends, position)
+                lost[owner] += 1
+                stats = owners[owner][1]
+                attempt = attempts.get(key, 0) + 1
+                if attempt > RETRIES:
+                    stats.errors += 1
                     continue
+                self.sequence += 1
+                ready = now + RETRY_DELAY * 2 ** (attempt - 1)
+                heapq.heappush(self.retries, (ready, self.sequence, attempt, key, batch[position][1], stats))
+                waiting[key] = self.sequence
+                stats.retries += 1
+        begin = 0
+        for (end, stats), count in zip(owners, lost):
+            stats.processed += end - begin - count
+            begin = end
+        stats = self.stats
+        stats.busy += latency
+        stats.batches += 1
+        stats.batch_size = self.sizer.size
+        stats.bytes_sent = self.memc.bytes_sent
+        stats.nodes = self.memc.report()
+
+
+def _add_owner(owners, end, stats):
+    if owners and owners[-1][1] is stats:
+        owners[-1] = (end, stats)
+    else:
+        owners.append((end, stats))
 
-                chunk[line[0]] = line[1]
-
-                if line == FINISH:
-                    self.results_queue.put((processed, errors))
-                    self.job_pool.task_done()
-                    logging.info('[Worker %s] Stop thread: %s' % (os.getpid(), self.name))
-                    break
-                else:
-                    if len(chunk) == CHUNK_SIZE:
-                        proc_items, err_items = insert_appsinstalled(self.memc, chunk)
-                        processed += proc_items
-                        errors += err_items
-                        chunk = dict()
-                        self.job_pool.task_done()
-            except Empty:
-                continue
 
+def file_handler(fn, options, device_memc, start=0, end=None):
+    stats = RangeStats(fn, start, end, device_memc)
+    checkpoint = load_checkpoint(fn, start, end) if options.resume else None
+    if checkpoint and checkpoint['complete']:
+        logging.info('[Worker %s] %s [%s:%s] is loaded already' % (os.getpid(), fn, start, end if end is not None else ''))
+        return fn, checkpoint['processed'], checkpoint['errors'], stats.report()
 
-def file_handler(fn, options, device_memc):
     jobs_pool = {}
     treads_pool = list()
-    results_queue = Queue()
-    for dev_type, address in device_memc.items():
-        memc = memcache.Client(servers=[address], socket_timeout=SOCKET_TIMEOUT, dead_retry=DEAD_RETRY)
-        jobs_pool[dev_type] = Queue()
-        thread = Worker(jobs_pool[dev_type], memc, results_queue, options.dry)
+    for dev_type, addresses in device_memc.items():
+        memc = ShardedPool(addresses, options.connections, SOCKET_TIMEOUT)
+        jobs_pool[dev_type.encode()] = Queue(QUEUE_BATCHES)
+        thread = Worker(jobs_pool[dev_type.encode()], memc, stats.targets[dev_type], options.dry, options.noreply,
+                        options.batch_size, options.target_latency)
         treads_pool.append(thread)
         thread.start()
 
     processed = errors = 0
-    logging.info('[Worker %s] Processing %s' % (os.getpid(), fn))
-    count = 0
-    fd = gzip.open(fn)
-    for line in fd:
-        line = line.decode().strip()
-        if not line:
+    skip = lines = 0
+    checkpointer = None
+    if checkpoint:
+        skip, lines = checkpoint['offset'], checkpoint['lines']
+        processed, errors = checkpoint['processed'], checkpoint['errors']
+        logging.info('[Worker %s] Resuming %s [%s:%s] from %s lines' % (
+            os.getpid(), fn, start, end if end is not None else '', lines))
+    if options.checkpoint_interval > 0 and not options.dry:
+        checkpointer = Checkpointer(fn, start, end, len(jobs_pool), processed, errors)
+    try:
+        read_range(fn, options, stats, jobs_pool, start, end, checkpointer, skip, lines)
+    finally:
+        # the workers must stop even when the file could not be read
+        for jobs in jobs_pool.values():
+            jobs.put(FINISH)
+        for tp in treads_pool:
+            tp.join()
+
+    # the workers are joined, their counters are final
+    for target in stats.targets.values():
+        processed += target.processed
+        errors += target.errors
+    errors += stats.bad
+    return fn, processed, errors, stats.report()
+
+
+def read_range(fn, options, stats, jobs_pool, start=0, end=None, checkpointer=None, skip=0, lines=0):
+    """Parses the lines of the range after `skip` decompressed bytes into the
+    batches of the target queues, counts skipped lines in stats.bad."""
+    next_checkpoint = time.monotonic() + options.checkpoint_interval
+    next_stats = time.monotonic() + options.stats_interval
+    named_queues = {dev_type.decode(): jobs for dev_type, jobs in jobs_pool.items()}
+    offset = 0
+    if start or end is not None:
+        logging.info('[Worker %s] Processing %s [%s:%s]' % (os.getpid(), fn, start, end if end is not None else ''))
+    else:
+        logging.info('[Worker %s] Processing %s' % (os.getpid(), fn))
+    bad = collections.Counter()
+    partial = 0
+    encoder = UserAppsEncoder()
+    dedup = DedupWindow(options.dedup_window, options.dedup_memory * 1024 * 1024) if options.dedup_window > 0 else None
+    batches = {dev_type: list() for dev_type in jobs_pool}
+    blocks = iter_blocks(fn, method=options.gzip, start=start, end=end)
+    try:
+        while True:
+            waited = time.monotonic()
+            block = next(blocks, None)
+            parse_started = time.monotonic()
+            stats.input_wait += parse_started - waited
+            if block is None:
+                break
+            offset += len(block)
+            if offset <= skip:
+                continue
+            if offset - len(block) < skip:
+                # checkpoints are at line ends, blocks of another run may end elsewhere
+                block = block[skip - offset + len(block):]
+            queue_wait = stats.queue_wait
+            parsed = parse_block(block)
+            lines += len(parsed.dev_ids)
+            stats.lines += len(parsed.dev_ids)
+            stats.bytes += len(block)
+            bad.update(parsed.bad)
+            partial += parsed.partial
+            columns = (parsed.dev_types, parsed.dev_ids, parsed.lats, parsed.lons, parsed.apps)
+            if dedup is None:
+                queue_records(stats, jobs_pool, batches, encoder, columns, options.batch_size, bad)
+            elif dedup.add(*columns):
+                queue_records(stats, jobs_pool, batches, encoder, dedup.drain(), options.batch_size, bad)
+            now = time.monotonic()
+            stats.parse += now - parse_started - (stats.queue_wait - queue_wait)
+            if checkpointer and now >= next_checkpoint:
+                if dedup is not None:
+                    queue_records(stats, jobs_pool, batches, encoder, dedup.drain(), options.batch_size, bad)
+                flush_batches(stats, jobs_pool, batches, checkpointer.mark(offset, lines, sum(bad.values())))
+                next_checkpoint = time.monotonic() + options.checkpoint_interval
+            if options.stats_interval > 0 and now >= next_stats:
+                stats.bad = sum(bad.values())
+                stats.dedup_saved = dedup.saved if dedup is not None else 0
+                stats.log_progress(named_queues)
+                next_stats = now + options.stats_interval
+        if dedup is not None:
+            queue_records(stats, jobs_pool, batches, encoder, dedup.drain(), options.batch_size, bad)
+        flush_batches(stats, jobs_pool, batches,
+                      checkpointer and checkpointer.mark(offset, lines, sum(bad.values()), True))
+    finally:
+        blocks.close()
+
+    if bad or partial:
+        logging.info("Bad lines in %s: skipped %s, with not numeric apps %s" % (fn, dict(bad), partial))
+    stats.bad = sum(bad.values())
+    if dedup is not None:
+        stats.dedup_saved = dedup.saved
+        logging.info("Duplicate keys in %s: %s sets saved" % (fn, dedup.saved))
+
+
+def queue_records(stats, jobs_pool, batches, encoder, columns, batch_size, bad):
+    """Encodes the records of the columns into the batches of their targets."""
+    dev_types, dev_ids, lats, lons, apps = columns
+    packed = encoder.encode_many(lats, lons, apps)
+    for dev_type, dev_id, value in zip(dev_types, dev_ids, packed):
+        batch = batches.get(dev_type)
+        if batch is None:
+            bad['dev_type'] += 1
+            continue
+        key = b'%s:%s' % (dev_type, dev_id)
+        if not valid_key(key):
+            bad['key'] += 1
             continue
-        appsinstalled = parse_appsinstalled(line)
-        jobs_pool[appsinstalled.dev_type].put(prepare_appsinstalled(appsinstalled))
+        batch.append((key, value))
+        if len(batch) >= batch_size:
+            # blocks while the memcached is QUEUE_BATCHES batches behind
+            put_job(stats, jobs_pool[dev_type], batch)
+            batches[dev_type] = list()
 
-        count = count + 1
-        if count % 300000 == 0:
-            while True:
-                size = jobs_pool[appsinstalled.dev_type].qsize()
-                if size < 1000:
-                    break
-                sleep(0.05)
 
-    for d_type in device_memc:
-        jobs_pool[d_type].put(FINISH)
+def put_job(stats, jobs, job):
+    waited = time.monotonic()
+    jobs.put(job)
+    stats.queue_wait += time.monotonic() - waited
 
-    for tp in treads_pool:
-        tp.join()
 
-    while not results_queue.empty():
-        result = results_queue.get(timeout=0.1)
-        processed += result[0]
-        errors += result[1]
+def flush_batches(stats, jobs_pool, batches, marker=None):
+    """Sends the incomplete batches and the checkpoint marker after them."""
+    for dev_type, batch in batches.items():
+        if batch:
+            put_job(stats, jobs_pool[dev_type], batch)
+            batches[dev_type] = list()
+        if marker:
+            put_job(stats, jobs_pool[dev_type], marker)
 
-    if not processed:
-        fd.close()
-        return fn
 
+def range_handler(args):
+    fn, options, device_memc, start, end = args
+    try:
+        return file_handler(fn, options, device_memc, start, end) + (True,)
+    except Exception as e:
+        logging.exception("Cannot load %s [%s:%s]: %s" % (fn, start, end if end is not None else '', e))
+        return fn, 0, 0, None, False
+
+
+class RingSink:
+    """Target queue of a parser process: batches go into the ring of the
+    writer of the device type, tagged with the range they come from."""
+
+    def __init__(self, ring, range_id):
+        self.ring = ring
+        self.range_id = range_id
+
+    def put(self, batch):
+        self.ring.put(ITEMS_FRAME, pack_items(self.range_id, batch))
+
+
+class RingJobs:
+    """Job pool of the Worker of a writer process read from its ring. Items
+    are counted per range, the end of a range is a Marker after which the
+    counters of the range are sent to the parent."""
+
+    def __init__(self, ring, dev_type, results):
+        self.ring = ring
+        self.dev_type = dev_type
+        self.results = results
+        self.ranges = dict()
+
+    def get(self):
+        kind, data = self.ring.get()
+        if kind == STOP_FRAME:
+            return FINISH
+        range_id, items = unpack_items(data)
+        if range_id not in self.ranges:
+            self.ranges[range_id] = (TargetStats(), time.monotonic())
+        if kind == END_FRAME:
+            return Marker(self, range_id)
+        return Batch(items, self.ranges[range_id][0])
+
+    def done(self, range_id, processed, errors):
+        """Called by the Worker when all keys of the range are written."""
+        stats, started = self.ranges.pop(range_id)
+        self.results.put(('writer', range_id, self.dev_type, stats.report(time.monotonic() - started)))
+
+
+def ring_parser(tasks, rings, options, results):
+    """Parser process: loads the ranges from the task queue into the rings."""
+    while True:
+        task = tasks.get()
+        if task is FINISH:
+            break
+        range_id, fn, start, end = task
+        stats = RangeStats(fn, start, end, ())
+        jobs_pool = {dev_type.encode(): RingSink(ring, range_id) for dev_type, ring in rings.items()}
+        ok = True
+        try:
+            read_range(fn, options, stats, jobs_pool, start, end)
+        except Exception as e:
+            logging.exception("Cannot load %s [%s:%s]: %s" % (fn, start, end if end is not None else '', e))
+            ok = False
+        finally:
+            for ring in rings.values():
+                ring.put(END_FRAME, pack_items(range_id, []))
+        results.put(('parser', range_id, stats.report(), ok))
+
+
+def ring_writer(dev_type, ring, addresses, options, results):
+    """Writer process of a device type: stores the records of its ring."""
+    memc = ShardedPool(addresses, options.connections, SOCKET_TIMEOUT)
+    stats = TargetStats()
+    started = time.monotonic()
+    worker = Worker(RingJobs(ring, dev_type, results), memc, stats, options.dry, options.noreply,
+                    options.batch_size, options.target_latency)
+    # the process has nothing else to do, the worker runs in its main thread
+    worker.run()
+    results.put(('stop', None, dev_type, stats.report(time.monotonic() - started)))
+
+
+def shm_load(process_args, options, device_memc, writer_reports):
+    """Parses the ranges in `workers` processes that put encoded records into
+    a shared memory ring per device type, a writer process per device type
+    stores them. Yields the results of the ranges like range_handler, fills
+    writer_reports with the totals of the writers."""
+    rings = {dev_type: RingBuffer(options.ring_size * 1024 * 1024) for dev_type in device_memc}
+    tasks = ProcessQueue()
+    results = ProcessQueue()
+    writers = [Process(target=ring_writer, args=(dev_type, rings[dev_type], addresses, options, results))
+               for dev_type, addresses in device_memc.items()]
+    parsers = [Process(target=ring_parser, args=(tasks, rings, options, results)) for _ in range(options.workers)]
+    for process in writers + parsers:
+        process.start()
+    for range_id, (fn, _, _, start, end) in enumerate(process_args):
+        tasks.put((range_id, fn, start, end))
+    for _ in parsers:
+        tasks.put(FINISH)
+
+    # range id -> parser message and writer reports
+    ranges = {range_id: [None, dict()] for range_id in range(len(process_args))}
+    try:
+        while ranges:
+            message = _get_result(results, writers + parsers)
+            kind, range_id = message[0], message[1]
+            if kind == 'parser':
+                ranges[range_id][0] = message
+            else:
+                ranges[range_id][1][message[2]] = message[3]
+            parsed, targets = ranges[range_id]
+            if parsed is None or len(targets) < len(writers):
+                continue
+            del ranges[range_id]
+            _, _, report, ok = parsed
+            report['targets'] = targets
+            processed = sum(target['processed'] for target in targets.values())
+            errors = sum(target['errors'] for target in targets.values()) + report['bad_lines']
+            yield process_args[range_id][0], processed, errors, report, ok
+        for process in parsers:
+            process.join()
+        for ring in rings.values():
+            ring.put(STOP_FRAME, b'')
+        while len(writer_reports) < len(writers):
+            _, _, dev_type, report = _get_result(results, writers)
+            writer_reports[dev_type] = report
+        for process in writers:
+            process.join()
+    finally:
+        for process in writers + parsers:
+            if process.is_alive():
+                process.terminate()
+        for ring in rings.values():
+            ring.close()
+            ring.unlink()
+
+
+def _get_result(results, processes):
+    while True:
+        try:
+            return results.get(timeout=PROCESS_CHECK)
+        except Empty:
+            for process in processes:
+                if process.exitcode:
+                    raise RuntimeError('%s exited with code %s' % (process.name, process.exitcode))
+
+
+def parse_servers(spec):
+    servers = [server.strip() for server in spec.split(',') if server.strip()]
+    if not servers:
+        raise ValueError('No memcached servers in %r' % spec)
+    return servers
+
+
+def check_error_rate(processed, errors):
+    if not processed:
+        return None
     err_rate = float(errors) / processed
     if err_rate < NORMAL_ERR_RATE:
         logging.info("Acceptable error rate (%s). Successfull load" % err_rate)
     else:
         logging.error("High error rate (%s > %s). Failed load" % (err_rate, NORMAL_ERR_RATE))
-    fd.close()
-
-    return fn
+    return err_rate
 
 
 def main(options):
+    # every device type may be sharded over several servers
     device_memc = {
-        "idfa": options.idfa,
-        "gaid": options.gaid,
-        "adid": options.adid,
-        "dvid": options.dvid,
+        "idfa": parse_servers(options.idfa),
+        "gaid": parse_servers(options.gaid),
+        "adid": parse_servers(options.adid),
+        "dvid": parse_servers(options.dvid),
     }
 
-    pool = Pool(options.workers)
-
-    process_args = ((fn, options, device_memc) for fn in sorted(glob.iglob(options.pattern)))
-    for file_name in pool.starmap(file_handler, process_args):
+    started = time.monotonic()
+
+    # a file is cut into ranges of gzip members that are loaded in parallel
+    process_args = list()
+    for fn in sorted(glob.iglob(options.pattern)):
+        ranges = split_ranges(fn, options.split) if options.split > 1 else [(0, None)]
+        process_args.extend((fn, options, device_memc, start, end) for start, end in ranges)
+    ranges_left = collections.Counter(args[0] for args in process_args)
+    reports = dict()
+    writer_reports = dict()
+
+    if options.shm:
+        if options.resume:
+            logging.info("Checkpoints are not used with --shm, the files are loaded from the start")
+        pool = None
+        results = shm_load(process_args, options, device_memc, writer_reports)
+    else:
+        pool = Pool(options.workers)
+        results = pool.imap(range_handler, process_args)
+
+    for file_name, processed, errors, range_report, ok in results:
+        report = reports.setdefault(file_name, {'ok': True, 'lines': 0, 'processed': 0, 'errors': 0, 'ranges': []})
+        report['processed'] += processed
+        report['errors'] += errors
+        report['ok'] = report['ok'] and ok
+        if range_report:
+            report['lines'] += range_report['lines']
+            report['ranges'].append(range_report)
+        ranges_left[file_name] -= 1
+        if ranges_left[file_name]:
+            continue
+        if not report['ok']:
+            logging.error("Not all ranges of %s were loaded, the file is kept for the next run" % file_name)
+            continue
+        report['err_rate'] = check_error_rate(report['processed'], report['errors'])
         dot_rename(file_name)
+        remove_checkpoints(file_name)
+    if pool is not None:
+        pool.close()
+
+    result = summary(reports, time.monotonic() - started, writer_reports)
+    logging.info("Summary: %s" % json.dumps({key: value for key, value in result.items() if key != 'files'}))
+    if options.summary:
+        with open(options.summary, 'w') as fd:
+            json.dump(result, fd, indent=2)
 
 
 def prototest():
     sample = "idfa\t1rfw452y52g2gg4g\t55.55\t42.42\t1423,43,567,3,7,23\ngaid\t7rfw452y52g2gq4g\t55.55\t42.42\t7423,424"
-    for line in sample.splitlines():
-        dev_type, dev_id, lat, lon, raw_apps = line.strip().split("\t")
+    encoder = UserAppsEncoder()
+    for line in sample.splitlines() + ["adid\tx\t-0.0\t1e300\t", "dvid\ty\t0\t-1.5\t0,127,128,16383,16384,4294967295"]:
+        dev_type, dev_id, lat, lon, raw_apps = line.split("\t")
         apps = [int(a) for a in raw_apps.split(",") if a.isdigit()]
         lat, lon = float(lat), float(lon)
         ua = appsinstalled_pb2.UserApps()
@@ -210,6 +658,46 @@ def prototest():
         unpacked = appsinstalled_pb2.UserApps()
         unpacked.ParseFromString(packed)
         assert ua == unpacked
+        assert encoder.encode(lat, lon, array('I', apps)) == packed
+
+    block = (sample + "\nidfa\t\t1\t2\t3\ngaid\tx\tnorth\t2\t3\nbroken line\n"
+             "adid\tz\t1\t2\t4,a,5\n").encode()
+    parsed = parse_block(block)
+    assert parsed.dev_ids == [b"1rfw452y52g2gg4g", b"7rfw452y52g2gq4g", b"z"]
+    assert list(parsed.apps[0]) == [1423, 43, 567, 3, 7, 23] and list(parsed.apps[2]) == [4, 5]
+    assert parsed.bad == {"no_id": 1, "geo": 1, "fields": 1} and parsed.partial == 1
+
+    servers = ["127.0.0.1:33013", "127.0.0.1:33017", "127.0.0.1:33018"]
+    keys = [b"idfa:%d" % index for index in range(3000)]
+    before = HashRing(servers)
+    after = HashRing(servers + ["127.0.0.1:33019"])
+    assert len(set(before.get(key) for key in keys)) == 3
+    # a new server only takes keys, the others keep theirs
+    assert all(after.get(key) in (before.get(key), "127.0.0.1:33019") for key in keys)
+
+    dedup = DedupWindow(size=3)
+    first = parse_block(b"idfa\ta\t1\t1\t1\ngaid\ta\t2\t2\t2\nidfa\ta\t3\t3\t3\n")
+    assert not dedup.add(first.dev_types, first.dev_ids, first.lats, first.lons, first.apps)
+    second = parse_block(b"idfa\tb\t4\t4\t4\n")
+    assert dedup.add(second.dev_types, second.dev_ids, second.lats, second.lons, second.apps)
+    dev_types, dev_ids, lats, lons, apps = dedup.drain()
+    # the latest line of a key is kept, in the order of the latest lines
+    assert dev_types == [b"gaid", b"idfa", b"idfa"] and dev_ids == [b"a", b"a", b"b"]
+    assert list(lats) == [2, 3, 4] and [list(a) for a in apps] == [[2], [3], [4]]
+    assert dedup.saved == 1 and len(dedup) == 0
+
+    ring = RingBuffer(256)
+    try:
+        for index in range(20):
+            items = [(b"idfa:%d" % index, b"v" * index), (b"gaid:%d" % index, b"")]
+            # frames of 40-60 bytes, some of them do not fit before the end of the ring
+            ring.put(ITEMS_FRAME, pack_items(index, items))
+            assert ring.get() == (ITEMS_FRAME, pack_items(index, items))
+            assert unpack_items(pack_items(index, items)) == (index, items)
+        assert ring.used() == 0
+    finally:
+        ring.close()
+        ring.unlink()
 
 
 if __name__ == '__main__':
@@ -223,6 +711,22 @@ if __name__ == '__main__':
     op.add_option("--adid", action="store", default="127.0.0.1:33015")
     op.add_option("--dvid", action="store", default="127.0.0.1:33016")
     op.add_option('-w', '--workers', action='store', type=int, default=cpu_count() + 1)
+    op.add_option('-b', '--batch-size', action='store', type=int, default=CHUNK_SIZE)
+    op.add_option('--target-latency', action='store', type=float, default=TARGET_LATENCY)
+    op.add_option('--dedup-window', action='store', type=int, default=0)
+    op.add_option('--dedup-memory', action='store', type=int, default=DEDUP_MEMORY // 1024 // 1024)
+    op.add_option('-c', '--connections', action='store', type=int, default=CONNECTIONS)
+    op.add_option('--noreply', action='store_true', default=False)
+    op.add_option('--gzip', action='store', type='choice', choices=METHODS, default='auto')
+    op.add_option('-s', '--split', action='store', type=int, default=1,
+                  help='load every file in up to SPLIT ranges at once; a key with lines in several '
+                       'ranges may keep the value of an earlier line')
+    op.add_option('--resume', action='store_true', default=False)
+    op.add_option('--checkpoint-interval', action='store', type=float, default=CHECKPOINT_INTERVAL)
+    op.add_option('--stats-interval', action='store', type=float, default=STATS_INTERVAL)
+    op.add_option('--summary', action='store', default=None)
+    op.add_option('--shm', action='store_true', default=False)
+    op.add_option('--ring-size', action='store', type=int, default=RING_SIZE // 1024 // 1024)
 
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO if not opts.dry else logging.DEBUG,
@@ -0,0 +1,122 @@
+import struct
+from array import array
+from itertools import chain
+from multiprocessing import Condition
+from multiprocessing.shared_memory import SharedMemory
+
+RING_SIZE = 64 * 1024 * 1024
+# bytes written and read since the start, they only grow
+_WRITTEN = struct.Struct('<Q')
+_READ = struct.Struct('<Q')
+_HEADER = _WRITTEN.size + _READ.size
+# kind and length of a frame
+_FRAME = struct.Struct('<II')
+_PAD = 0xffffffff
+# tag and count of records of a frame of items
+_ITEMS = struct.Struct('<II')
+
+
+class RingBuffer:
+    """Frames of bytes in a shared memory block, put by any number of
+    processes and got by one. A frame never wraps around the end of the
+    block, the bytes left there are skipped. The positions live in the block
+    and change under the condition; the reader copies a frame out without
+    holding it, writers do not touch the bytes that are not read yet.
+
+    The block is created by the parent and inherited by the processes it
+    starts, only the parent unlinks it."""
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.condition = Condition()
+        self.shm = SharedMemory(create=True, size=_HEADER + size)
+        _WRITTEN.pack_into(self.shm.buf, 0, 0)
+        _READ.pack_into(self.shm.buf, _WRITTEN.size, 0)
+
+    def __repr__(self):
+        return 'RingBuffer({}, {})'.format(self.shm.name, self.size)
+
+    def used(self):
+        buffer = self.shm.buf
+        with self.condition:
+            return _WRITTEN.unpack_from(buffer, 0)[0] - _READ.unpack_from(buffer, _WRITTEN.size)[0]
+
+    def put(self, kind, data):
+        """Copies a frame into the ring, blocks while it has no room."""
+        need = _FRAME.size + len(data)
+        if need > self.size:
+            raise ValueError('Frame of %d bytes does not fit the ring of %d' % (need, self.size))
+        buffer = self.shm.buf
+        with self.condition:
+            while True:
+                written = _WRITTEN.unpack_from(buffer, 0)[0]
+                read = _READ.unpack_from(buffer, _WRITTEN.size)[0]
+                offset = written % self.size
+                skip = self.size - offset if self.size - offset < need else 0
+                if written + skip + need - read <= self.size:
+                    break
+                self.condition.wait()
+            if skip >= _FRAME.size:
+                _FRAME.pack_into(buffer, _HEADER + offset, _PAD, 0)
+            if skip:
+                offset = 0
+            start = _HEADER + offset
+            _FRAME.pack_into(buffer, start, kind, len(data))
+            buffer[start + _FRAME.size:start + need] = data
+            _WRITTEN.pack_into(buffer, 0, written + skip + need)
+            self.condition.notify_all()
+
+    def get(self):
+        """Returns the kind and the data of the next frame, blocks while the
+        ring is empty. Must be called by one process only."""
+        buffer = self.shm.buf
+        with self.condition:
+            while True:
+                written = _WRITTEN.unpack_from(buffer, 0)[0]
+                read = _READ.unpack_from(buffer, _WRITTEN.size)[0]
+                if written == read:
+                    self.condition.wait()
+                    continue
+                offset = read % self.size
+                if self.size - offset >= _FRAME.size:
+                    kind, length = _FRAME.unpack_from(buffer, _HEADER + offset)
+                    if kind != _PAD:
+                        break
+                # the end of the block is skipped by the writer
+                _READ.pack_into(buffer, _WRITTEN.size, read + self.size - offset)
+                self.condition.notify_all()
+        start = _HEADER + offset + _FRAME.size
+        data = bytes(buffer[start:start + length])
+        with self.condition:
+            _READ.pack_into(buffer, _WRITTEN.size, read + _FRAME.size + length)
+            self.condition.notify_all()
+        return kind, data
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def pack_items(tag, items):
+    """Frame data of [(key, value)] bytes pairs: the tag, the count, the
+    lengths of all keys and values and then the keys and values."""
+    lengths = array('I', map(len, chain.from_iterable(items)))
+    return b''.join(chain((_ITEMS.pack(tag, len(items)), lengths.tobytes()), chain.from_iterable(items)))
+
+
+def unpack_items(data):
+    """Returns the tag and the [(key, value)] pairs of pack_items data."""
+    tag, count = _ITEMS.unpack_from(data)
+    position = _ITEMS.size + count * 2 * array('I').itemsize
+    lengths = array('I')
+    lengths.frombytes(data[_ITEMS.size:position])
+    items = list()
+    sizes = iter(lengths)
+    for key_length, value_length in zip(sizes, sizes):
+        key_end = position + key_length
+        end = key_end + value_length
+        items.append((data[position:key_end], data[key_end:end]))
+        position = end
+    return tag, items
@@ -0,0 +1,121 @@
+import os
+import time
+import logging
+
+STATS_INTERVAL = 10
+TARGET_FIELDS = ('batches', 'processed', 'errors', 'retries', 'bytes_sent')
+STAGE_FIELDS = ('input_wait', 'parse', 'queue_wait')
+
+
+class TargetStats:
+    """Counters of the worker of one memcached. Only the worker updates
+    them, the producer reads them for progress lines."""
+
+    def __init__(self):
+        self.batches = 0
+        self.processed = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        # size of the last write batch chosen by the worker
+        self.batch_size = 0
+        # seconds spent writing batches, the rest of the time the worker waited for them
+        self.busy = 0.0
+        # keys sent and failed and bytes per server of the device type
+        self.nodes = dict()
+
+    def report(self, seconds):
+        report = {field: getattr(self, field) for field in TARGET_FIELDS}
+        report['keys_per_second'] = round(self.processed / seconds, 1) if seconds else None
+        report['batch_size'] = self.batch_size
+        report['busy'] = round(self.busy / seconds, 3) if seconds else None
+        report['nodes'] = self.nodes
+        return report
+
+
+class RangeStats:
+    """Counters of one file or range: lines parsed by the producer, the
+    seconds it spent waiting for decompressed input, parsing and encoding,
+    and waiting for room in the target queues, plus TargetStats per target.
+    The stage with most of the time is the one that limits the load."""
+
+    def __init__(self, fn, start, end, targets):
+        self.fn = fn
+        self.start = start
+        self.end = end
+        self.started = time.monotonic()
+        self.lines = 0
+        self.bytes = 0
+        self.bad = 0
+        # sets skipped because a later line of the dedup window had the same key
+        self.dedup_saved = 0
+        self.input_wait = 0.0
+        self.parse = 0.0
+        self.queue_wait = 0.0
+        self.targets = {target: TargetStats() for target in targets}
+        self._last = (self.started, 0, {target: 0 for target in targets})
+
+    def seconds(self):
+        return time.monotonic() - self.started
+
+    def log_progress(self, queues):
+        """Logs the rates since the previous progress line and queue depths."""
+        now = time.monotonic()
+        last_time, last_lines, last_processed = self._last
+        interval = (now - last_time) or 1e-9
+        logging.info('[Worker %s] %s: %s lines, %.0f lines/s, input wait %.1fs, parse %.1fs, queue wait %.1fs, '
+                     'dedup saved %s' % (os.getpid(), self.fn, self.lines, (self.lines - last_lines) / interval,
+                                         self.input_wait, self.parse, self.queue_wait, self.dedup_saved))
+        for target, stats in self.targets.items():
+            logging.info('[Worker %s]   %s: stored %s, %.0f keys/s, errors %s, retries %s, batch %s, queue %s/%s, sent %.1f MB' % (
+                os.getpid(), target, stats.processed, (stats.processed - last_processed[target]) / interval,
+                stats.errors, stats.retries, stats.batch_size, queues[target].qsize(), queues[target].maxsize,
+                stats.bytes_sent / 1024 / 1024))
+        self._last = (now, self.lines, {target: stats.processed for target, stats in self.targets.items()})
+
+    def report(self):
+        seconds = self.seconds()
+        report = {
+            'start': self.start,
+            'end': self.end,
+            'seconds': round(seconds, 3),
+            'lines': self.lines,
+            'bad_lines': self.bad,
+            'dedup_saved': self.dedup_saved,
+            'bytes': self.bytes,
+            'lines_per_second': round(self.lines / seconds, 1) if seconds else None,
+        }
+        for field in STAGE_FIELDS:
+            report[field] = round(getattr(self, field), 3)
+        report['targets'] = {target: stats.report(seconds) for target, stats in self.targets.items()}
+        return report
+
+
+def summary(files, seconds, writers=None):
+    """Totals of the range reports of every file for the summary at exit.
+    `writers` are the reports of the writer processes of --shm, they have
+    the batches, bytes and servers of all ranges of their target."""
+    totals = {'seconds': round(seconds, 3), 'lines': 0, 'processed': 0, 'errors': 0, 'dedup_saved': 0}
+    targets = dict()
+    for file_report in files.values():
+        for field in ('lines', 'processed', 'errors'):
+            totals[field] += file_report[field]
+        for range_report in file_report['ranges']:
+            totals['dedup_saved'] += range_report['dedup_saved']
+            for target, stats in range_report['targets'].items():
+                target_totals = targets.setdefault(target, {field: 0 for field in TARGET_FIELDS})
+                for field in TARGET_FIELDS:
+                    target_totals[field] += stats[field]
+                nodes = target_totals.setdefault('nodes', dict())
+                for address, node in stats['nodes'].items():
+                    node_totals = nodes.setdefault(address, dict.fromkeys(node, 0))
+                    for field, value in node.items():
+                        node_totals[field] += value
+    for target, report in (writers or {}).items():
+        target_totals = targets.setdefault(target, {field: 0 for field in TARGET_FIELDS})
+        for field in ('batches', 'bytes_sent', 'nodes'):
+            target_totals[field] = report[field]
+    totals['lines_per_second'] = round(totals['lines'] / seconds, 1) if seconds else None
+    totals['targets'] = targets
+    totals['files'] = files
+    return totals
@@ -0,0 +1,61 @@
+import struct
+
+# field keys of appsinstalled.proto: apps = 1 (varint), lat = 2, lon = 3 (64-bit)
+APPS_TAG = 0x08
+LAT_TAG = 0x11
+LON_TAG = 0x19
+# "apps" fields of the ids below this limit are encoded once up front
+TABLE_SIZE = 1 << 14
+
+_GEO = struct.Struct('<BdBd')
+
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _app_field(app):
+    return bytes((APPS_TAG,)) + _varint(app)
+
+
+_APP_FIELDS = [_app_field(app) for app in range(TABLE_SIZE)]
+
+
+class UserAppsEncoder:
+    """Serializes UserApps messages byte for byte as appsinstalled_pb2 does.
+    The schema is proto2 without [packed=true], so every app is its own
+    tagged varint, followed by lat and lon as fixed 64-bit doubles. Messages
+    of a batch are written into one reused bytearray."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def encode(self, lat, lon, apps):
+        return self.encode_many((lat,), (lon,), (apps,))[0]
+
+    def encode_many(self, lats, lons, apps_lists):
+        """Returns the serialized messages of the given columns as bytes."""
+        buffer = self.buffer
+        del buffer[:]
+        ends = list()
+        fields = _APP_FIELDS.__getitem__
+        pack_geo = _GEO.pack
+        for lat, lon, apps in zip(lats, lons, apps_lists):
+            try:
+                buffer += b''.join(map(fields, apps))
+            except IndexError:
+                buffer += b''.join(map(_app_field, apps))
+            buffer += pack_geo(LAT_TAG, lat, LON_TAG, lon)
+            ends.append(len(buffer))
+        data = bytes(buffer)
+        start = 0
+        messages = list()
+        for end in ends:
+            messages.append(data[start:end])
+            start = end
+        return messages
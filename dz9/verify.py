@@ -0,0 +1,223 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import collections
+from optparse import OptionParser
+
+from google.protobuf.message import DecodeError
+
+import appsinstalled_pb2
+from gzinput import iter_blocks, METHODS
+from memc_async import ShardedPool, CONNECTIONS
+from memc_load import parse_block, parse_servers, NORMAL_ERR_RATE, SOCKET_TIMEOUT
+
+SAMPLES = 1000
+# mismatched keys logged per file
+LOG_MISMATCHES = 10
+
+
+def sample_records(path, count, rnd, method='auto'):
+    """Reservoir sample of `count` keys of the file with the latest line of
+    every sampled key, which is the one the loader stores last. Only the
+    sampled lines are parsed, the lines the loader skips are left out."""
+    slots = dict()
+    lines = list()
+    seen = 0
+    for block in iter_blocks(path, method=method):
+        for line in block.split(b'\n'):
+            if not line:
+                continue
+            key = tuple(line.strip().split(b'\t', 2)[:2])
+            slot = slots.get(key)
+            if slot is not None:
+                lines[slot] = line
+                continue
+            seen += 1
+            if len(lines) < count:
+                slots[key] = len(lines)
+                lines.append(line)
+                continue
+            slot = rnd.randrange(seen)
+            if slot < count:
+                del slots[tuple(lines[slot].strip().split(b'\t', 2)[:2])]
+                slots[key] = slot
+                lines[slot] = line
+    parsed = parse_block(b'\n'.join(lines))
+    return list(zip(parsed.dev_types, parsed.dev_ids, parsed.lats, parsed.lons, parsed.apps))
+
+
+def compare(record, value):
+    """Returns the reason the stored value differs from the record or None."""
+    if value is None:
+        return 'missing'
+    ua = appsinstalled_pb2.UserApps()
+    try:
+        ua.ParseFromString(value)
+    except DecodeError:
+        return 'undecodable'
+    _, _, lat, lon, apps = record
+    if ua.lat != lat or ua.lon != lon:
+        return 'geo'
+    if list(ua.apps) != list(apps):
+        return 'apps'
+    return None
+
+
+async def fetch(pools, keys):
+    """Gets the keys of every device type concurrently, returns the values
+    and the seconds every device type took."""
+    async def fetch_target(dev_type):
+        started = time.perf_counter()
+        values = await pools[dev_type].get_many(keys[dev_type])
+        return dev_type, values, time.perf_counter() - started
+
+    results = await asyncio.gather(*(fetch_target(dev_type) for dev_type in keys))
+    return {dev_type: (values, seconds) for dev_type, values, seconds in results}
+
+
+def split_files(summary_path):
+    """Files of a loader --summary that were loaded in several ranges, mapped
+    to the number of ranges. The ranges are stored concurrently, so a key
+    repeated across them may keep a line other than the latest."""
+    with open(summary_path) as fd:
+        files = json.load(fd)['files']
+    return {os.path.realpath(name): len(report['ranges'])
+            for name, report in files.items() if len(report['ranges']) > 1}
+
+
+def loaded_name(path):
+    """Name of the file at load time, the loader prefixes it with a dot."""
+    head, fn = os.path.split(path)
+    return os.path.realpath(os.path.join(head, fn[1:] if fn.startswith('.') else fn))
+
+
+def verify_file(path, pools, options, loop):
+    rnd = random.Random(options.seed)
+    started = time.perf_counter()
+    samples = sample_records(path, options.samples, rnd, options.gzip)
+    sampled = time.perf_counter() - started
+
+    keys = collections.defaultdict(list)
+    unknown = 0
+    for record in samples:
+        dev_type = record[0].decode()
+        if dev_type not in pools:
+            # the loader skips them too
+            unknown += 1
+            continue
+        keys[dev_type].append(b'%s:%s' % (record[0], record[1]))
+
+    started = time.perf_counter()
+    fetched = loop.run_until_complete(fetch(pools, keys))
+    fetch_seconds = time.perf_counter() - started
+
+    reasons = collections.Counter()
+    targets = dict()
+    logged = 0
+    for record in samples:
+        dev_type = record[0].decode()
+        if dev_type not in pools:
+            continue
+        key = b'%s:%s' % (record[0], record[1])
+        values, _ = fetched[dev_type]
+        reason = compare(record, values.get(key))
+        target = targets.setdefault(dev_type, {'keys': 0, 'missing': 0, 'mismatched': 0})
+        target['keys'] += 1
+        if reason is None:
+            continue
+        reasons[reason] += 1
+        target['missing' if reason == 'missing' else 'mismatched'] += 1
+        if logged < LOG_MISMATCHES:
+            logging.error("%s: %s %s" % (path, key.decode(), reason))
+            logged += 1
+    for dev_type, target in targets.items():
+        seconds = fetched[dev_type][1]
+        target['seconds'] = round(seconds, 3)
+        target['keys_per_second'] = round(target['keys'] / seconds, 1) if seconds else None
+
+    checked = sum(target['keys'] for target in targets.values())
+    failed = sum(reasons.values())
+    return {
+        'file': path,
+        'sampled': len(samples),
+        'checked': checked,
+        'unknown_dev_type': unknown,
+        'missing': reasons['missing'],
+        'mismatched': failed - reasons['missing'],
+        'reasons': dict(reasons),
+        'mismatch_rate': round(failed / checked, 6) if checked else None,
+        'sample_seconds': round(sampled, 3),
+        'fetch_seconds': round(fetch_seconds, 3),
+        'keys_per_second': round(checked / fetch_seconds, 1) if fetch_seconds else None,
+        'targets': targets,
+    }
+
+
+def main(options, paths):
+    device_memc = {
+        "idfa": parse_servers(options.idfa),
+        "gaid": parse_servers(options.gaid),
+        "adid": parse_servers(options.adid),
+        "dvid": parse_servers(options.dvid),
+    }
+    pools = {dev_type: ShardedPool(addresses, options.connections, SOCKET_TIMEOUT)
+             for dev_type, addresses in device_memc.items()}
+    split = split_files(options.summary) if options.summary else dict()
+    loop = asyncio.new_event_loop()
+    reports = list()
+    try:
+        for path in paths:
+            ranges = split.get(loaded_name(path))
+            if ranges:
+                logging.warning("%s was loaded in %s ranges with --split, the latest line of a key is not "
+                                "always the stored one, skipped" % (path, ranges))
+                reports.append({'file': path, 'skipped': 'split', 'ranges': ranges})
+                continue
+            report = verify_file(path, pools, options, loop)
+            logging.info("%s: checked %s keys, missing %s, mismatched %s, rate %s, %s keys/s" % (
+                path, report['checked'], report['missing'], report['mismatched'],
+                report['mismatch_rate'], report['keys_per_second']))
+            reports.append(report)
+    finally:
+        for pool in pools.values():
+            pool.close()
+        loop.close()
+    return reports
+
+
+if __name__ == '__main__':
+    op = OptionParser(usage='%prog [options] FILE...')
+    op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-n", "--samples", action="store", type=int, default=SAMPLES)
+    op.add_option("--seed", action="store", type=int, default=None)
+    op.add_option("--idfa", action="store", default="127.0.0.1:33013")
+    op.add_option("--gaid", action="store", default="127.0.0.1:33014")
+    op.add_option("--adid", action="store", default="127.0.0.1:33015")
+    op.add_option("--dvid", action="store", default="127.0.0.1:33016")
+    op.add_option('-c', '--connections', action='store', type=int, default=CONNECTIONS)
+    op.add_option('--gzip', action='store', type='choice', choices=METHODS, default='auto')
+    op.add_option('--max-mismatch', action='store', type=float, default=NORMAL_ERR_RATE)
+    op.add_option('-o', '--output', action='store', default=None)
+    op.add_option('--summary', action='store', default=None)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.INFO, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    if not args:
+        op.error('no files to verify')
+
+    results = main(opts, args)
+    output = json.dumps(results, indent=2)
+    if opts.output:
+        with open(opts.output, 'w') as fd:
+            fd.write(output + '\n')
+    print(output)
+    failed = [report['file'] for report in results if 'skipped' not in report and
+              (report['mismatch_rate'] is None or report['mismatch_rate'] > opts.max_mismatch)]
+    if failed:
+        logging.error("Mismatch rate above %s in %s" % (opts.max_mismatch, ', '.join(failed)))
+        sys.exit(1)
+    logging.info("Verified %s files" % sum(1 for report in results if 'skipped' not in report))